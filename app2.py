@@ -3,13 +3,36 @@ import os
 import json
 import time
 import random
+import math
 import re 
 from dotenv import load_dotenv 
-from pydantic import BaseModel, Field, ValidationError
-from typing import List, Optional, Union
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+import groq
+import httpx
 from groq import Groq 
+from groq.types.chat import ChatCompletion, ChatCompletionChunk
 from json.decoder import JSONDecodeError
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait, TimeoutError as FuturesTimeoutError
 import hashlib
+import codecs
+import io
+import mmap
+import zipfile
+import xml.etree.ElementTree as ElementTree
+import uuid
+import logging
+import contextvars
+import sqlite3
+import threading
+import queue
+import atexit
+import unicodedata
+import difflib
+from collections import Counter, OrderedDict, deque
+from contextlib import closing
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 #Structures Pydantic pour génération et correction
 
@@ -35,265 +58,2482 @@ class CorrectionFeedback(BaseModel):
     feedback_text: str = Field(description="Une explication courte et constructive justifiant le score et indiquant ce qui manque ou ce qui est correct.")
     is_correct: bool = Field(description="True si le score_percentage est >= 70, False sinon.")
 
-#Config Groq
+#Config Groq et modèle local
 
-load_dotenv()
+@st.cache_resource(show_spinner=False)
+def load_environment() -> dict:
+    """Lit le fichier .env une seule fois par processus et retourne la configuration (variables d'environnement) figée.
 
-GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+    Streamlit ré-exécute ce script à chaque interaction : sans ce cache, chaque clic relirait le fichier .env.
+    """
+    load_dotenv()
+    return dict(os.environ)
+
+ENV = load_environment()
+# Modèle rapide (niveau "fast") de Groq : corrections et générations simples.
+LLM_MODEL = ENV.get("GROQ_MODEL", "llama-3.1-8b-instant")
+# Connexions HTTP gardées ouvertes entre les appels (évite un handshake TLS par requête).
+LLM_HTTP_MAX_CONNECTIONS = 20
+LLM_HTTP_KEEPALIVE_S = 120.0
+# Serveur local compatible OpenAI, en complément ou à la place de Groq (ex. http://127.0.0.1:8080/v1 pour llama.cpp).
+LOCAL_LLM_URL = ENV.get("AKALEARN_LOCAL_LLM_URL")
+LOCAL_LLM_MODEL = ENV.get("AKALEARN_LOCAL_LLM_MODEL", "llama3.1:8b")
+LOCAL_LLM_MIN_TIMEOUT_S = float(ENV.get("AKALEARN_LOCAL_LLM_TIMEOUT", "180"))
+# "latency" : fournisseur le plus rapide d'abord (p95 observé) ; "priority" : Groq d'abord, le local en secours.
+LLM_ROUTING = ENV.get("AKALEARN_LLM_ROUTING", "latency")
+# Modèles plus capables (niveau "large") pour les générations exigeantes ; vide : un seul modèle par fournisseur.
+LLM_LARGE_MODEL = ENV.get("AKALEARN_LARGE_MODEL", "llama-3.3-70b-versatile")
+LOCAL_LLM_LARGE_MODEL = ENV.get("AKALEARN_LOCAL_LLM_LARGE_MODEL", "")
+# Modèles susceptibles de servir un appel (niveau choisi par appel, bascule entre fournisseurs) : tous entrent dans les clés de cache.
+LLM_CACHE_MODELS = [LLM_MODEL, LLM_LARGE_MODEL] + ([LOCAL_LLM_MODEL, LOCAL_LLM_LARGE_MODEL] if LOCAL_LLM_URL else [])
+# Générations confiées au grand modèle : difficultés exigeantes, ou long texte source (tokens du prompt) hors difficulté "Facile".
+LARGE_MODEL_DIFFICULTIES = ("Difficile", "Expert")
+LARGE_MODEL_MIN_PROMPT_TOKENS = 2500
+# Fenêtre glissante des derniers appels par fournisseur et type d'appel (latence p95, taux d'erreurs).
+LLM_STATS_WINDOW = 50
+# Au-delà de ce taux de pannes sur la fenêtre, un fournisseur passe après tous les autres.
+LLM_MAX_ERROR_RATE = 0.2
+# Requêtes couvertes : si la réponse tarde au-delà du percentile observé (p95 : au plus ~5 % d'appels en plus), une copie part
+# et la première réponse l'emporte.
+LLM_HEDGE_REQUESTS = ENV.get("AKALEARN_HEDGE_REQUESTS", "1") == "1"
+HEDGE_LATENCY_PERCENTILE = 0.95
+# Plafond du délai en multiple de la médiane : si les appels lents dépassent 5 % de la fenêtre, le p95 tombe dans la queue.
+HEDGE_MAX_MEDIAN_FACTOR = 3.0
+HEDGE_MIN_SAMPLES = 10
+HEDGE_MIN_DELAY_S = 0.5
+HEDGE_MAX_WORKERS = 32
+
+#Config difficulte
+def get_difficulty_instructions(difficulty: str) -> str:
+    """Fournit des instructions spécifiques au LLM pour moduler la complexité cognitive."""
+    if difficulty == "Facile":
+        return "Les questions doivent se concentrer sur les définitions et les faits directement cités, ne nécessitant aucune inférence."
+    elif difficulty == "Moyen":
+        return "Les questions doivent porter sur la compréhension des relations de cause à effet et l'application simple des concepts décrits."
+    elif difficulty == "Difficile":
+        return "Les questions doivent exiger la synthèse de plusieurs idées, la justification d'un processus, ou l'interprétation de données non explicites."
+    elif difficulty == "Expert":
+        return "Les questions doivent nécessiter une analyse critique approfondie, une comparaison d'éléments ou une extrapolation des conséquences au-delà du texte immédiat."
+    return ""
+#Cache persistant des examens générés
+
+# Versions des prompts de génération et de correction : à incrémenter dès qu'un prompt change pour invalider le cache.
+PROMPT_VERSION = "v2"
+GRADING_PROMPT_VERSION = "v2"
+CACHE_DB_PATH = ENV.get("AKALEARN_CACHE_DB", ".akalearn_cache.sqlite3")
+GENERATION_CACHE_TTL_S = 7 * 24 * 3600
+GENERATION_CACHE_MAX_ENTRIES = 500
+
+QUESTION_MODELS = {m.__name__: m for m in (VraiFauxQuestion, MCQQuestion, QuestionOuverte)}
+
+@st.cache_resource(show_spinner=False)
+def init_cache_db(path: str) -> bool:
+    """Crée les tables du cache une seule fois par processus ; False si la base est inutilisable."""
+    try:
+        with closing(sqlite3.connect(path, timeout=5)) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS generation_cache ("
+                "key TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS grading_cache ("
+                "key TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            # La clé primaire (texte, type, difficulté, question) sert aussi d'index pour tirer les questions d'un texte.
+            # source_start / source_end : passage du texte d'origine dont vient la question (NULL si inconnu).
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS question_bank ("
+                "source_fp TEXT NOT NULL, model TEXT NOT NULL, difficulty TEXT NOT NULL, question_id TEXT NOT NULL, "
+                "topic TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL, "
+                "source_start INTEGER, source_end INTEGER, "
+                "PRIMARY KEY (source_fp, model, difficulty, question_id))"
+            )
+            # Bases créées avant l'ajout des positions dans le texte source.
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(question_bank)")}
+            if "source_start" not in columns:
+                conn.execute("ALTER TABLE question_bank ADD COLUMN source_start INTEGER")
+                conn.execute("ALTER TABLE question_bank ADD COLUMN source_end INTEGER")
+            # Texte extrait des documents importés, par empreinte du fichier (une réimportation ne réextrait rien).
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS document_text ("
+                "file_hash TEXT NOT NULL, max_chars INTEGER NOT NULL, text TEXT NOT NULL, truncated INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, PRIMARY KEY (file_hash, max_chars))"
+            )
+        return True
+    except sqlite3.Error:
+        return False
+
+CACHE_DB_READY = init_cache_db(CACHE_DB_PATH)
+
+def open_cache_db() -> sqlite3.Connection:
+    """Ouvre une connexion à la base SQLite locale du cache (tables créées par init_cache_db)."""
+    return sqlite3.connect(CACHE_DB_PATH, timeout=5)
+
+def generation_cache_key(text_source: str, difficulty: str, num_questions: int, type_question: str, temperature: float) -> str:
+    """Empreinte SHA-256 de tous les paramètres qui influencent la génération."""
+    payload = json.dumps(
+        [PROMPT_VERSION, LLM_CACHE_MODELS, text_source, difficulty, num_questions, type_question, round(temperature, 2)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def get_cached_questions(key: str) -> Optional[List[BaseModel]]:
+    """Retourne les questions validées associées à la clé, ou None (absente, expirée ou illisible)."""
+    try:
+        with closing(open_cache_db()) as conn, conn:
+            row = conn.execute(
+                "SELECT payload FROM generation_cache WHERE key = ? AND created_at >= ?",
+                (key, time.time() - GENERATION_CACHE_TTL_S)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE generation_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        return [QUESTION_MODELS[item.pop('__type__')](**item) for item in json.loads(row[0])]
+    except (sqlite3.Error, KeyError, TypeError, ValueError):
+        return None
+
+def store_cached_questions(key: str, questions: List[BaseModel]) -> None:
+    """Enregistre les questions puis évince les entrées expirées et les moins récemment utilisées."""
+    payload = json.dumps([{'__type__': type(q).__name__, **q.model_dump()} for q in questions], ensure_ascii=False)
+    now = time.time()
+    try:
+        with closing(open_cache_db()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO generation_cache (key, payload, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, payload, now, now)
+            )
+            conn.execute("DELETE FROM generation_cache WHERE created_at < ?", (now - GENERATION_CACHE_TTL_S,))
+            conn.execute(
+                "DELETE FROM generation_cache WHERE key NOT IN "
+                "(SELECT key FROM generation_cache ORDER BY last_access DESC LIMIT ?)",
+                (GENERATION_CACHE_MAX_ENTRIES,)
+            )
+    except sqlite3.Error:
+        # Le cache est une optimisation : une base indisponible ne doit pas bloquer la génération.
+        pass
+
+#Banque de questions persistante
+
+def source_fingerprint(text_source: str) -> str:
+    """Empreinte SHA-256 du texte source (unicode et espaces normalisés) : un même cours recollé retrouve ses questions."""
+    return hashlib.sha256(" ".join(unicodedata.normalize("NFKC", text_source).split()).encode()).hexdigest()
+
+def sample_balanced_by_topic(questions: List[BaseModel], num_questions: int) -> List[BaseModel]:
+    """Tirage aléatoire qui alterne entre les thèmes, pour qu'un examen ne se concentre pas sur une seule notion."""
+    by_topic = {}
+    for question in questions:
+        by_topic.setdefault(question.topic.casefold().strip(), []).append(question)
+    groups = list(by_topic.values())
+    random.shuffle(groups)
+    for group in groups:
+        random.shuffle(group)
+    sampled = []
+    for rank in range(max((len(g) for g in groups), default=0)):
+        sampled.extend(group[rank] for group in groups if rank < len(group))
+    return sampled[:num_questions]
+
+def draw_from_question_bank(source_fp: str, difficulty: str, num_questions: int, type_question: str) -> List[BaseModel]:
+    """Jusqu'à `num_questions` questions déjà validées pour ce texte, ce type et cette difficulté ([] si la banque est vide ou illisible)."""
+    target_model = get_target_config(type_question)[0]
+    try:
+        with closing(open_cache_db()) as conn:
+            rows = conn.execute(
+                "SELECT payload FROM question_bank WHERE source_fp = ? AND model = ? AND difficulty = ?",
+                (source_fp, target_model.__name__, difficulty)
+            ).fetchall()
+        questions = [target_model.model_validate_json(row[0]) for row in rows]
+    except (sqlite3.Error, ValidationError):
+        return []
+    return sample_balanced_by_topic(questions, num_questions)
+
+def store_in_question_bank(source_fp: str, difficulty: str, questions: List[BaseModel], sources: Optional[List[Optional[Tuple[int, int]]]] = None) -> None:
+    """Ajoute les questions validées à la banque ; une question déjà présente (même forme canonique) est ignorée.
+
+    `sources` donne pour chaque question sa position (début, fin) dans le texte d'origine, ou None.
+    """
+    now = time.time()
+    sources = sources or [None] * len(questions)
+    rows = [
+        (source_fp, type(q).__name__, difficulty, hashlib.sha1(question_fingerprint(q).encode()).hexdigest(), q.topic, q.model_dump_json(), now,
+         *(span or (None, None)))
+        for q, span in zip(questions, sources)
+    ]
+    try:
+        with closing(open_cache_db()) as conn, conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO question_bank (source_fp, model, difficulty, question_id, topic, payload, created_at, source_start, source_end) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+    except sqlite3.Error:
+        pass
+
+#Cache des corrections de questions ouvertes
+
+GRADING_MEMORY_CACHE_MAX_ENTRIES = 2048
+@st.cache_resource(show_spinner=False)
+def init_grading_memory_cache():
+    """Niveau mémoire partagé par toutes les sessions du processus (accédé depuis les threads de correction)."""
+    return OrderedDict(), threading.Lock()
+
+_GRADING_MEMORY_CACHE, _GRADING_MEMORY_CACHE_LOCK = init_grading_memory_cache()
+
+def normalize_grading_text(text: str) -> str:
+    """Normalise un texte (unicode, casse, espaces) pour que des réponses équivalentes aient la même empreinte."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def grading_cache_key(question_text: str, user_answer: str, expected_keywords: List[str]) -> str:
+    """Empreinte SHA-256 normalisée de (question, mots-clés, réponse)."""
+    payload = json.dumps(
+        [
+            GRADING_PROMPT_VERSION,
+            LLM_CACHE_MODELS,
+            normalize_grading_text(question_text),
+            sorted(normalize_grading_text(k) for k in expected_keywords),
+            normalize_grading_text(user_answer)
+        ],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _remember_feedback(key: str, feedback: CorrectionFeedback) -> None:
+    with _GRADING_MEMORY_CACHE_LOCK:
+        _GRADING_MEMORY_CACHE[key] = feedback
+        _GRADING_MEMORY_CACHE.move_to_end(key)
+        while len(_GRADING_MEMORY_CACHE) > GRADING_MEMORY_CACHE_MAX_ENTRIES:
+            _GRADING_MEMORY_CACHE.popitem(last=False)
+
+def get_cached_feedback(key: str) -> Optional[CorrectionFeedback]:
+    """Cherche une correction en mémoire puis sur disque ; None si la réponse n'a jamais été corrigée."""
+    with _GRADING_MEMORY_CACHE_LOCK:
+        feedback = _GRADING_MEMORY_CACHE.get(key)
+        if feedback is not None:
+            _GRADING_MEMORY_CACHE.move_to_end(key)
+            return feedback
+    try:
+        with closing(open_cache_db()) as conn:
+            row = conn.execute("SELECT payload FROM grading_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        feedback = CorrectionFeedback.model_validate_json(row[0])
+    except (sqlite3.Error, ValidationError):
+        return None
+    _remember_feedback(key, feedback)
+    return feedback
+
+def store_cached_feedback(key: str, feedback: CorrectionFeedback) -> None:
+    """Enregistre une correction réussie en mémoire et sur disque."""
+    _remember_feedback(key, feedback)
+    try:
+        with closing(open_cache_db()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO grading_cache (key, payload, created_at) VALUES (?, ?, ?)",
+                (key, feedback.model_dump_json(), time.time())
+            )
+    except sqlite3.Error:
+        pass
+
+#Télémétrie des appels LLM
+
+# Export optionnel : port HTTP des métriques Prometheus et fichier de logs JSON (une ligne par appel).
+METRICS_PORT = ENV.get("AKALEARN_METRICS_PORT")
+TELEMETRY_LOG_PATH = ENV.get("AKALEARN_TELEMETRY_LOG")
+LATENCY_BUCKETS_S = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TELEMETRY_MAX_SESSIONS = 1000
+
+telemetry_logger = logging.getLogger("akalearn.telemetry")
+
+@dataclass
+class LLMCallRecord:
+    """Mesures d'un appel LLM (toutes tentatives confondues)."""
+    call_site: str
+    model: str
+    session_id: Optional[str] = None
+    latency_s: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    salvaged: int = 0
+    dropped: int = 0
+    success: bool = False
+    # Une copie couverte (hedge) de la requête a été envoyée.
+    hedged: bool = False
+    error: Optional[str] = None
+    timestamp: float = 0.0
+
+class TelemetryStore:
+    """Agrégats des appels LLM du processus (par site d'appel et modèle) et résumés par session."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._sessions = OrderedDict()
+        # Session Streamlit courante, propagée aux threads de travail via contextvars.copy_context().
+        self.session = contextvars.ContextVar("akalearn_telemetry_session", default=None)
+
+    @staticmethod
+    def _empty_series() -> dict:
+        return {
+            'calls': 0, 'failures': 0, 'retries': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+            'salvaged': 0, 'dropped': 0, 'hedged': 0, 'latency_sum': 0.0, 'latency_buckets': [0] * len(LATENCY_BUCKETS_S)
+        }
+
+    @staticmethod
+    def _add(series: dict, record: LLMCallRecord) -> None:
+        series['calls'] += 1
+        series['failures'] += 0 if record.success else 1
+        series['retries'] += record.retries
+        series['prompt_tokens'] += record.prompt_tokens
+        series['completion_tokens'] += record.completion_tokens
+        series['salvaged'] += record.salvaged
+        series['dropped'] += record.dropped
+        series['hedged'] += int(record.hedged)
+        series['latency_sum'] += record.latency_s
+        for i, bound in enumerate(LATENCY_BUCKETS_S):
+            if record.latency_s <= bound:
+                series['latency_buckets'][i] += 1
+
+    def record(self, record: LLMCallRecord) -> None:
+        with self._lock:
+            self._add(self._series.setdefault((record.call_site, record.model), self._empty_series()), record)
+            if record.session_id is not None:
+                session = self._sessions.setdefault(record.session_id, {})
+                self._sessions.move_to_end(record.session_id)
+                self._add(session.setdefault(record.call_site, self._empty_series()), record)
+                while len(self._sessions) > TELEMETRY_MAX_SESSIONS:
+                    self._sessions.popitem(last=False)
+        telemetry_logger.info(json.dumps(asdict(record), ensure_ascii=False))
+
+    def session_summary(self, session_id: str) -> List[dict]:
+        """Une ligne par site d'appel pour la session : appels, tokens, latence moyenne, retries, taux de récupération."""
+        with self._lock:
+            per_site = {site: dict(series) for site, series in self._sessions.get(session_id, {}).items()}
+        rows = []
+        for site, series in sorted(per_site.items()):
+            validated = series['salvaged'] + series['dropped']
+            rows.append({
+                "Appel": site,
+                "Appels": series['calls'],
+                "Échecs": series['failures'],
+                "Retries": series['retries'],
+                "Requêtes couvertes": series['hedged'],
+                "Tokens entrée": series['prompt_tokens'],
+                "Tokens sortie": series['completion_tokens'],
+                "Latence moy. (s)": round(series['latency_sum'] / series['calls'], 2),
+                "Récupération (%)": round(100 * series['salvaged'] / validated) if validated else None
+            })
+        return rows
+
+    def to_prometheus(self) -> str:
+        """Exposition des métriques au format texte Prometheus."""
+        with self._lock:
+            series = {key: dict(value, latency_buckets=list(value['latency_buckets'])) for key, value in self._series.items()}
+        counters = (
+            ('akalearn_llm_calls_total', 'calls', "Appels LLM."),
+            ('akalearn_llm_failures_total', 'failures', "Appels LLM en échec après toutes les tentatives."),
+            ('akalearn_llm_retries_total', 'retries', "Nouvelles tentatives d'appels LLM."),
+            ('akalearn_llm_prompt_tokens_total', 'prompt_tokens', "Tokens d'entrée consommés."),
+            ('akalearn_llm_completion_tokens_total', 'completion_tokens', "Tokens de sortie consommés."),
+            ('akalearn_llm_salvaged_items_total', 'salvaged', "Objets JSON validés dans les réponses."),
+            ('akalearn_llm_dropped_items_total', 'dropped', "Objets JSON rejetés par la validation."),
+            ('akalearn_llm_hedged_requests_total', 'hedged', "Appels LLM doublés par une requête couverte.")
+        )
+        lines = []
+        for name, field, help_text in counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (site, model), values in sorted(series.items()):
+                lines.append(f'{name}{{call_site="{site}",model="{model}"}} {values[field]}')
+        lines += ["# HELP akalearn_llm_latency_seconds Durée des appels LLM, retries inclus.", "# TYPE akalearn_llm_latency_seconds histogram"]
+        for (site, model), values in sorted(series.items()):
+            labels = f'call_site="{site}",model="{model}"'
+            for bound, count in zip(LATENCY_BUCKETS_S, values['latency_buckets']):
+                lines.append(f'akalearn_llm_latency_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'akalearn_llm_latency_seconds_bucket{{{labels},le="+Inf"}} {values["calls"]}')
+            lines.append(f'akalearn_llm_latency_seconds_sum{{{labels}}} {values["latency_sum"]:.6f}')
+            lines.append(f'akalearn_llm_latency_seconds_count{{{labels}}} {values["calls"]}')
+        return "\n".join(lines) + "\n"
+
+def start_metrics_server(store: TelemetryStore, port: int) -> None:
+    """Sert /metrics (format Prometheus) dans un thread démon."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = store.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+@st.cache_resource(show_spinner=False)
+def init_telemetry() -> TelemetryStore:
+    """Store de télémétrie unique par processus ; démarre les exports configurés."""
+    store = TelemetryStore()
+    if TELEMETRY_LOG_PATH:
+        handler = logging.FileHandler(TELEMETRY_LOG_PATH, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        telemetry_logger.addHandler(handler)
+        telemetry_logger.setLevel(logging.INFO)
+    if METRICS_PORT:
+        try:
+            start_metrics_server(store, int(METRICS_PORT))
+        except (OSError, ValueError) as e:
+            telemetry_logger.warning(f"Serveur de métriques non démarré sur le port {METRICS_PORT} : {e}")
+    return store
+
+TELEMETRY = init_telemetry()
+
+def submit_with_context(executor: ThreadPoolExecutor, fn: Callable, *args, **kwargs):
+    """Soumet une tâche en lui transmettant le contexte courant (session de télémétrie)."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+#Couche d'appel LLM partagée (retries, limitation de débit, disjoncteur)
+
+LLM_BACKOFF_BASE_S = 0.5
+LLM_BACKOFF_MAX_S = 8.0
+# Attente maximale tolérée (limiteur ou retry-after) avant d'abandonner plutôt que de bloquer l'utilisateur.
+LLM_MAX_WAIT_S = 10.0
+# Quotas côté client du fournisseur Groq, alignés sur ceux de la clé partagée.
+LLM_REQUESTS_PER_MINUTE = int(ENV.get("GROQ_REQUESTS_PER_MINUTE", "30"))
+LLM_TOKENS_PER_MINUTE = int(ENV.get("GROQ_TOKENS_PER_MINUTE", "6000"))
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_S = 30.0
+
+class LLMUnavailableError(Exception):
+    """Levée sans appel réseau quand le disjoncteur est ouvert ou que le limiteur imposerait une trop longue attente."""
+
+class GenerationCancelledError(Exception):
+    """Levée sans appel réseau quand la génération en cours a été annulée (plus personne n'attend son résultat)."""
+
+# Signal d'annulation de la génération en cours, propagé aux threads de travail comme la session de télémétrie.
+GENERATION_CANCEL_EVENT = contextvars.ContextVar("akalearn_generation_cancel", default=None)
+
+class TokenBucket:
+    """Seau à jetons thread-safe : `rate_per_minute` jetons par minute, rafale maximale `capacity`."""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate_per_s = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_s)
+        self._updated_at = now
+
+    def acquire(self, amount: float = 1, max_wait: float = LLM_MAX_WAIT_S) -> bool:
+        """Réserve `amount` jetons en attendant au plus `max_wait` secondes ; False si l'attente serait plus longue."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            wait = max(0.0, (amount - self._tokens) / self.rate_per_s)
+            if wait > max_wait:
+                return False
+            # Réservation immédiate (solde éventuellement négatif) : les appels concurrents attendent leur tour.
+            self._tokens -= amount
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def consume(self, amount: float) -> None:
+        """Décompte des jetons après coup (ex. tokens de complétion réellement utilisés), sans attendre."""
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+class CircuitBreaker:
+    """Disjoncteur : après `failure_threshold` échecs consécutifs, refuse les appels pendant `reset_after_s` secondes."""
+
+    def __init__(self, failure_threshold: int = CIRCUIT_BREAKER_FAILURE_THRESHOLD, reset_after_s: float = CIRCUIT_BREAKER_RESET_S):
+        self.failure_threshold = failure_threshold
+        self.reset_after_s = reset_after_s
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self.reset_after_s - (time.monotonic() - self._opened_at)
+            if remaining > 0:
+                raise LLMUnavailableError(f"Service LLM dégradé : nouvel essai possible dans {remaining:.0f}s.")
+            # Semi-ouvert : un seul appel de test passe. Le circuit reste ouvert pour les autres appelants jusqu'à son issue
+            # (record_success le ferme, record_failure le rouvre) ; s'il ne rend jamais compte, un autre test passe au délai suivant.
+            self._failures = self.failure_threshold - 1
+            self._opened_at = time.monotonic()
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+#Fournisseurs LLM (Groq, serveur local compatible OpenAI)
+
+class LLMProvider:
+    """Backend de complétion de chat au format OpenAI, avec ses garde-fous et sa latence observée par type d'appel.
+
+    `create()` retourne une réponse (ou un flux) au format du SDK Groq, quel que soit le backend.
+    """
+
+    def __init__(self, name: str, model: str, request_limiter: Optional[TokenBucket] = None, token_limiter: Optional[TokenBucket] = None, tier: str = "fast"):
+        self.name = name
+        self.model = model
+        # "fast" : modèle rapide (corrections, générations simples) ; "large" : modèle plus capable (générations exigeantes).
+        self.tier = tier
+        self.request_limiter = request_limiter
+        self.token_limiter = token_limiter
+        self.circuit_breaker = CircuitBreaker()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def create(self, messages: List[dict], temperature: float, timeout: Optional[float] = None, **create_kwargs):
+        raise NotImplementedError
+
+    def acquire(self, prompt_tokens: int, max_wait: float) -> bool:
+        """Réserve une requête et les tokens du prompt auprès des limiteurs du fournisseur (s'il en a)."""
+        if self.request_limiter is not None and not self.request_limiter.acquire(1, max_wait):
+            return False
+        return self.token_limiter is None or self.token_limiter.acquire(prompt_tokens, max_wait)
+
+    def observe(self, call_site: str, latency_s: float, success: bool = True) -> None:
+        """Ajoute un appel à la fenêtre glissante de son type (une génération et une correction n'ont pas la même durée)."""
+        with self._lock:
+            self._stats.setdefault(call_site, deque(maxlen=LLM_STATS_WINDOW)).append((latency_s, success))
+
+    def latency_samples(self, call_site: str) -> int:
+        with self._lock:
+            return sum(1 for _, success in self._stats.get(call_site, ()) if success)
+
+    def latency_percentile(self, call_site: str, percentile: float = 0.95) -> float:
+        """Percentile de latence des appels réussis de la fenêtre ; 0 si jamais mesuré, pour que le fournisseur soit évalué au moins une fois."""
+        with self._lock:
+            latencies = sorted(latency for latency, success in self._stats.get(call_site, ()) if success)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+    def error_rate(self, call_site: str) -> float:
+        with self._lock:
+            window = self._stats.get(call_site, ())
+            return sum(1 for _, success in window if not success) / len(window) if window else 0.0
+
+class GroqProvider(LLMProvider):
+    """API Groq via le SDK officiel ; les quotas de la clé sont appliqués côté client."""
+
+    def __init__(self, client: Groq, model: str, request_limiter: TokenBucket, token_limiter: TokenBucket, tier: str = "fast"):
+        # Les quotas Groq s'appliquent par modèle : chaque modèle a ses propres limiteurs.
+        super().__init__("groq", model, request_limiter, token_limiter, tier)
+        self.client = client
+
+    def create(self, messages: List[dict], temperature: float, timeout: Optional[float] = None, **create_kwargs):
+        return self.client.chat.completions.create(model=self.model, messages=messages, temperature=temperature, timeout=timeout, **create_kwargs)
+
+class LocalCompletionStream:
+    """Flux SSE d'un serveur local, itérable comme un flux du SDK Groq (`chunk.choices[0].delta.content`)."""
+
+    def __init__(self, response: httpx.Response):
+        self._response = response
+
+    def __iter__(self) -> Iterator[ChatCompletionChunk]:
+        for line in self._response.iter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                return
+            yield ChatCompletionChunk.construct(**json.loads(data))
+
+    def close(self) -> None:
+        self._response.close()
+
+class LocalOpenAIProvider(LLMProvider):
+    """Serveur local compatible OpenAI (llama.cpp `llama-server`, Ollama, vLLM...) : fonctionne sans réseau ni clé.
+
+    Pas de quota à respecter ; les erreurs HTTP sont levées en `httpx.HTTPStatusError`.
+    """
+
+    def __init__(self, base_url: str, model: str, min_timeout_s: float, tier: str = "fast"):
+        super().__init__("local", model, tier=tier)
+        self.min_timeout_s = min_timeout_s
+        self._http = httpx.Client(
+            base_url=base_url.rstrip("/") + "/",
+            timeout=min_timeout_s,
+            limits=httpx.Limits(max_connections=LLM_HTTP_MAX_CONNECTIONS, keepalive_expiry=LLM_HTTP_KEEPALIVE_S)
+        )
+
+    def create(self, messages: List[dict], temperature: float, timeout: Optional[float] = None, stream: bool = False, **create_kwargs):
+        # Les modèles sur CPU sont bien plus lents que Groq : les délais prévus pour l'API sont relevés.
+        timeout = max(timeout or 0.0, self.min_timeout_s)
+        payload = {"model": self.model, "messages": messages, "temperature": temperature, "stream": stream, **create_kwargs}
+        if not stream:
+            response = self._http.post("chat/completions", json=payload, timeout=timeout)
+            response.raise_for_status()
+            return ChatCompletion.construct(**response.json())
+        response = self._http.send(self._http.build_request("POST", "chat/completions", json=payload, timeout=timeout), stream=True)
+        if response.is_error:
+            response.read()
+            response.close()
+            response.raise_for_status()
+        return LocalCompletionStream(response)
+
+@st.cache_resource(show_spinner=False)
+def init_llm_providers():
+    """Construit une seule fois par processus les fournisseurs configurés, par ordre de priorité : Groq puis le serveur local.
+
+    Chaque modèle est un fournisseur à part (niveau "fast" ou "large"), avec ses limiteurs, son disjoncteur et ses mesures.
+
+    Streamlit ré-exécute ce script à chaque interaction : sans ce cache, chaque clic recréerait les clients et leurs pools de connexions.
+    Les limiteurs et disjoncteurs sont ainsi partagés par toutes les sessions. Retourne (fournisseurs, message_erreur).
+    """
+    providers = []
+    errors = []
+    api_key = ENV.get("GROQ_API_KEY")
+    if api_key:
+        try:
+            http_client = groq.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_HTTP_MAX_CONNECTIONS,
+                    keepalive_expiry=LLM_HTTP_KEEPALIVE_S
+                )
+            )
+            # Les retries sont gérés par call_llm (pas de retries cachés dans le SDK).
+            client = Groq(api_key=api_key, max_retries=0, http_client=http_client)
+            providers.append(GroqProvider(client, LLM_MODEL, TokenBucket(LLM_REQUESTS_PER_MINUTE), TokenBucket(LLM_TOKENS_PER_MINUTE)))
+            if LLM_LARGE_MODEL and LLM_LARGE_MODEL != LLM_MODEL:
+                providers.append(GroqProvider(client, LLM_LARGE_MODEL, TokenBucket(LLM_REQUESTS_PER_MINUTE), TokenBucket(LLM_TOKENS_PER_MINUTE), tier="large"))
+        except Exception as e:
+            errors.append(f"ERREUR d'initialisation du client Groq : {e}")
+    if LOCAL_LLM_URL:
+        providers.append(LocalOpenAIProvider(LOCAL_LLM_URL, LOCAL_LLM_MODEL, LOCAL_LLM_MIN_TIMEOUT_S))
+        if LOCAL_LLM_LARGE_MODEL and LOCAL_LLM_LARGE_MODEL != LOCAL_LLM_MODEL:
+            providers.append(LocalOpenAIProvider(LOCAL_LLM_URL, LOCAL_LLM_LARGE_MODEL, LOCAL_LLM_MIN_TIMEOUT_S, tier="large"))
+    if not providers and not errors:
+        errors.append(
+            "ERREUR: Aucun fournisseur LLM configuré.\n"
+            "Veuillez définir la variable d'environnement GROQ_API_KEY dans le fichier .env, "
+            "ou AKALEARN_LOCAL_LLM_URL pour un modèle local (ex. http://127.0.0.1:8080/v1)."
+        )
+    return providers, "\n".join(errors) or None
+
+LLM_PROVIDERS, LLM_INIT_ERROR = init_llm_providers()
+if LLM_INIT_ERROR:
+    st.error(LLM_INIT_ERROR)
+
+def select_model_tier(call_site: str, difficulty: Optional[str], prompt_tokens: int) -> str:
+    """Niveau de modèle d'un appel : les corrections et générations simples vont au modèle rapide, les générations exigeantes au grand modèle."""
+    if not call_site.startswith("generation") or difficulty is None:
+        return "fast"
+    if difficulty in LARGE_MODEL_DIFFICULTIES or (difficulty != "Facile" and prompt_tokens >= LARGE_MODEL_MIN_PROMPT_TOKENS):
+        return "large"
+    return "fast"
+
+def route_providers(call_site: str, tier: str = "fast") -> List[LLMProvider]:
+    """Ordre d'essai des fournisseurs pour un appel.
+
+    Les fournisseurs en panne fréquente passent en dernier, puis ceux du niveau demandé passent devant les autres
+    (qui restent en secours) ; à niveau égal, le p95 le plus bas d'abord en routage "latency", sinon l'ordre de priorité.
+    """
+    def rank(provider: LLMProvider):
+        latency = provider.latency_percentile(call_site) if LLM_ROUTING == "latency" else 0.0
+        return (provider.error_rate(call_site) > LLM_MAX_ERROR_RATE, provider.tier != tier, latency)
+
+    # Tri stable : à rang égal, l'ordre de priorité est conservé.
+    return sorted(LLM_PROVIDERS, key=rank)
+
+def acquire_provider(providers: List[LLMProvider], prompt_tokens: int, max_wait_s: Optional[float] = None) -> LLMProvider:
+    """Premier fournisseur disponible (disjoncteur fermé, quota disponible) ; LLMUnavailableError si aucun.
+
+    Seul le dernier candidat peut faire attendre le limiteur (au plus `max_wait_s`, LLM_MAX_WAIT_S par défaut) :
+    tant qu'il reste un autre fournisseur, mieux vaut s'y reporter.
+    """
+    if max_wait_s is None:
+        max_wait_s = LLM_MAX_WAIT_S
+    error = LLMUnavailableError("Aucun fournisseur LLM configuré.")
+    for i, provider in enumerate(providers):
+        try:
+            provider.circuit_breaker.before_call()
+        except LLMUnavailableError as e:
+            error = e
+            continue
+        if provider.acquire(prompt_tokens, max_wait_s if i == len(providers) - 1 else 0.0):
+            return provider
+        error = LLMUnavailableError("Limite de débit atteinte côté client : réessayez dans quelques instants.")
+    raise error
+
+# Fonctions appelées avec l'objet `usage` de chaque réponse réussie (ex. comptage de tokens du mode batch).
+LLM_USAGE_OBSERVERS = []
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Délai demandé par le serveur (en-têtes `retry-after-ms` / `retry-after`) pour une erreur HTTP, sinon None."""
+    if not isinstance(error, (groq.APIStatusError, httpx.HTTPStatusError)):
+        return None
+    headers = error.response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+def compute_backoff(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Backoff exponentiel avec jitter complet ; le délai imposé par le serveur est prioritaire."""
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * 2 ** attempt))
+
+def is_service_failure(error: Exception) -> bool:
+    """Erreurs qui traduisent une dégradation du service (comptées par le disjoncteur)."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (groq.APITimeoutError, groq.APIConnectionError, groq.InternalServerError, httpx.TransportError))
+
+def is_rate_limited(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429
+    return isinstance(error, groq.RateLimitError)
+
+def is_retryable(error: Exception) -> bool:
+    # ValueError : JSON invalide ou validation Pydantic échouée sur la réponse.
+    return is_service_failure(error) or is_rate_limited(error) or isinstance(error, ValueError)
+
+@st.cache_resource(show_spinner=False)
+def init_hedge_pool():
+    """Pool de threads des requêtes couvertes et sémaphore de ses threads libres, partagés par tout le processus."""
+    executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="akalearn-hedge")
+    return executor, threading.BoundedSemaphore(HEDGE_MAX_WORKERS)
+
+HEDGE_EXECUTOR, HEDGE_SLOTS = init_hedge_pool()
+
+def submit_hedge_request(fn: Callable, *args, **kwargs) -> Future:
+    """Soumet fn sur un thread déjà réservé dans HEDGE_SLOTS ; la réservation est libérée à la fin de la requête.
+
+    Un thread réservé est forcément libre : la requête démarre dès sa soumission, sans file d'attente,
+    et le délai de couverture mesure bien la latence du fournisseur.
+    """
+    try:
+        future = submit_with_context(HEDGE_EXECUTOR, fn, *args, **kwargs)
+    except BaseException:
+        HEDGE_SLOTS.release()
+        raise
+    future.add_done_callback(lambda _: HEDGE_SLOTS.release())
+    return future
+
+def hedge_delay(provider: LLMProvider, call_site: str) -> Optional[float]:
+    """Attente avant d'envoyer une copie : le percentile HEDGE_LATENCY_PERCENTILE observé, plafonné à HEDGE_MAX_MEDIAN_FACTOR fois la médiane.
+
+    None tant que le fournisseur n'est pas assez mesuré (pas de copie).
+    """
+    if not LLM_HEDGE_REQUESTS or provider.latency_samples(call_site) < HEDGE_MIN_SAMPLES:
+        return None
+    delay = min(provider.latency_percentile(call_site, HEDGE_LATENCY_PERCENTILE),
+                HEDGE_MAX_MEDIAN_FACTOR * provider.latency_percentile(call_site, 0.5))
+    return max(HEDGE_MIN_DELAY_S, delay)
+
+def acquire_hedge_provider(providers: List[LLMProvider], primary: LLMProvider, prompt_tokens: int) -> Optional[LLMProvider]:
+    """Fournisseur de la copie : un autre backend du même niveau de modèle de préférence, sinon le même ; jamais d'attente de quota."""
+    candidates = [p for p in providers if p is not primary and p.tier == primary.tier] + [primary]
+    for provider in candidates:
+        try:
+            provider.circuit_breaker.before_call()
+        except LLMUnavailableError:
+            continue
+        if provider.acquire(prompt_tokens, 0.0):
+            return provider
+    return None
+
+def settle_hedge_loser(future: Future, provider: LLMProvider, call_site: str, started: float) -> None:
+    """La requête perdante se termine en arrière-plan : ses mesures, son disjoncteur et sa consommation sont quand même comptés."""
+    try:
+        response = future.result()
+    except Exception as e:
+        if is_service_failure(e):
+            provider.circuit_breaker.record_failure()
+            provider.observe(call_site, time.perf_counter() - started, success=False)
+        return
+    provider.circuit_breaker.record_success()
+    provider.observe(call_site, time.perf_counter() - started)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        if provider.token_limiter is not None:
+            provider.token_limiter.consume(usage.completion_tokens)
+        for observer in LLM_USAGE_OBSERVERS:
+            observer(usage)
+
+def create_with_hedge(provider: LLMProvider, providers: List[LLMProvider], call_site: str, prompt_tokens: int, record: LLMCallRecord, messages: List[dict], temperature: float, timeout: Optional[float], **create_kwargs):
+    """Envoie la requête ; sans réponse au-delà de hedge_delay(), une copie part et la première réponse réussie l'emporte.
+
+    Pas de copie si le pool n'a plus de thread libre : la couverture ne s'applique que hors saturation.
+    Retourne (fournisseur gagnant, réponse, latence de sa requête). Si les deux échouent, l'erreur de la première est relancée.
+    """
+    delay = hedge_delay(provider, call_site)
+    started = time.perf_counter()
+    # Sans thread libre (processus saturé), l'appel part directement sans couverture : doubler la charge n'aiderait pas.
+    if delay is None or create_kwargs.get("stream") or not HEDGE_SLOTS.acquire(blocking=False):
+        response = provider.create(messages, temperature, timeout=timeout, **create_kwargs)
+        return provider, response, time.perf_counter() - started
+
+    primary = submit_hedge_request(provider.create, messages, temperature, timeout=timeout, **create_kwargs)
+    try:
+        return provider, primary.result(timeout=delay), time.perf_counter() - started
+    except FuturesTimeoutError:
+        pass
+    backup_provider = None
+    if HEDGE_SLOTS.acquire(blocking=False):
+        backup_provider = acquire_hedge_provider(providers, provider, prompt_tokens)
+        if backup_provider is None:
+            HEDGE_SLOTS.release()
+    if backup_provider is None:
+        return provider, primary.result(), time.perf_counter() - started
+
+    record.hedged = True
+    backup_started = time.perf_counter()
+    backup = submit_hedge_request(backup_provider.create, messages, temperature, timeout=timeout, **create_kwargs)
+    requests = {primary: (provider, started), backup: (backup_provider, backup_started)}
+    pending = set(requests)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((future for future in done if future.exception() is None), None)
+        if winner is None:
+            continue
+        # Requête perdante : comptée dès maintenant si elle a échoué, sinon à sa fin.
+        for loser in set(requests) - {winner}:
+            loser_provider, loser_started = requests[loser]
+            loser.add_done_callback(lambda f, p=loser_provider, t=loser_started: settle_hedge_loser(f, p, call_site, t))
+        winner_provider, winner_started = requests[winner]
+        return winner_provider, winner.result(), time.perf_counter() - winner_started
+    # Les deux ont échoué : la panne de la copie est comptée ici, celle de la requête principale par l'appelant.
+    settle_hedge_loser(backup, backup_provider, call_site, backup_started)
+    raise primary.exception()
+
+def call_llm(messages: List[dict], temperature: float, max_retries: int = 3, timeout: Optional[float] = None, parse: Optional[Callable[[str], object]] = None, response_model: Optional[type] = None, on_retry: Optional[Callable[[int, Exception, float], None]] = None, call_site: str = "autre", difficulty: Optional[str] = None, max_wait_s: Optional[float] = None, **create_kwargs):
+    """Point de passage unique des appels LLM : routage entre fournisseurs, limiteur, disjoncteur, retries avec backoff et `retry-after`.
+
+    Si `response_model` est fourni, le contenu est extrait et validé avec ce modèle (liste retournée, nouvel essai
+    si rien n'est récupérable). Si `parse` est fourni, il reçoit le contenu texte et son résultat est retourné ; une
+    ValueError levée par `parse` déclenche un nouvel essai. Sinon la réponse brute (ou le flux) est retournée.
+    `on_retry(attempt, error, wait)` est appelé avant chaque attente. La dernière erreur est relancée.
+    Chaque appel est mesuré (tokens, latence, retries, récupération) sous le nom `call_site`.
+    Le niveau de modèle est choisi d'après `call_site`, `difficulty` et la taille du prompt (select_model_tier).
+    `max_wait_s` borne les attentes (limiteur, retry-after) de cet appel ; LLM_MAX_WAIT_S par défaut.
+    Une panne ou un quota atteint chez un fournisseur reporte immédiatement la tentative suivante sur un autre.
+    Dans une génération annulée (GENERATION_CANCEL_EVENT), lève GenerationCancelledError sans appel réseau.
+    """
+    cancel_event = GENERATION_CANCEL_EVENT.get()
+    if cancel_event is not None and cancel_event.is_set():
+        raise GenerationCancelledError("Génération annulée.")
+    record = LLMCallRecord(call_site=call_site, model=LLM_MODEL, session_id=TELEMETRY.session.get(), timestamp=time.time())
+    start = time.perf_counter()
+    prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+    if max_wait_s is None:
+        max_wait_s = LLM_MAX_WAIT_S
+    providers = route_providers(call_site, select_model_tier(call_site, difficulty, prompt_tokens))
+    # Les reports vers un autre fournisseur ne consomment pas de tentative.
+    failovers = 0
+    try:
+        for attempt in range(max_retries + len(providers) - 1):
+            provider = acquire_provider(providers, prompt_tokens, max_wait_s)
+            record.model = provider.model
+            attempt_start = time.perf_counter()
+            try:
+                provider, response, latency_s = create_with_hedge(provider, providers, call_site, prompt_tokens, record, messages, temperature, timeout, **create_kwargs)
+                record.model = provider.model
+                provider.circuit_breaker.record_success()
+                provider.observe(call_site, latency_s)
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    record.prompt_tokens += usage.prompt_tokens
+                    record.completion_tokens += usage.completion_tokens
+                    if provider.token_limiter is not None:
+                        provider.token_limiter.consume(usage.completion_tokens)
+                    for observer in LLM_USAGE_OBSERVERS:
+                        observer(usage)
+                if response_model is not None:
+                    items, report = extract_with_report(response.choices[0].message.content.strip(), response_model)
+                    record.salvaged += report.salvaged
+                    record.dropped += report.dropped
+                    if not items:
+                        raise ValueError(f"Aucun objet JSON valide dans la sortie LLM ({report.dropped} rejeté(s) par la validation Pydantic).")
+                    result = items
+                elif parse is not None:
+                    result = parse(response.choices[0].message.content.strip())
+                else:
+                    result = response
+                record.success = True
+                return result
+            except Exception as e:
+                if is_service_failure(e):
+                    provider.circuit_breaker.record_failure()
+                    # Les pannes font monter le taux d'erreurs : au-delà de LLM_MAX_ERROR_RATE, le routage délaisse ce fournisseur.
+                    provider.observe(call_site, time.perf_counter() - attempt_start, success=False)
+                if (is_service_failure(e) or is_rate_limited(e)) and failovers < len(providers) - 1:
+                    # Secours : le fournisseur en échec passe en dernier et la tentative suivante part aussitôt ailleurs.
+                    failovers += 1
+                    providers.remove(provider)
+                    providers.append(provider)
+                    wait = 0.0
+                else:
+                    wait = compute_backoff(attempt - failovers, get_retry_after(e))
+                    if not is_retryable(e) or attempt - failovers >= max_retries - 1 or wait > max_wait_s:
+                        raise
+                record.retries += 1
+                if on_retry is not None:
+                    on_retry(attempt, e, wait)
+                time.sleep(wait)
+    except Exception as e:
+        record.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record.latency_s = time.perf_counter() - start
+        TELEMETRY.record(record)
+
+#Fonctions génération et validation ---
+
+def get_target_config(type_question: str):
+    if type_question == "Vrai/Faux":
+        return VraiFauxQuestion, "VRAI/FAUX : chaque question doit être une affirmation à laquelle on répond par True ou False.", [
+            {"question": "L'eau bout à 100 degrés Celsius au niveau de la mer.", "correct_answer": True, "topic": "Point d'ébullition"}
+        ]
+    elif type_question == "Ouvert":
+        return QuestionOuverte, "OUVERTE : chaque question doit nécessiter une réponse courte. Le champ 'keywords' doit contenir les éléments de correction.", [
+            {"question": "Quelle est la formule chimique de l'eau?", "keywords": ["H2O", "hydrogène", "oxygène"], "topic": "Formule chimique"}
+        ]
+    else: 
+        return MCQQuestion, "QCM : chaque question doit avoir 4 options (options), dont une seule est la bonne (correct_answer).", [
+            {"question": "Quel gaz est produit à la cathode lors de l'électrolyse de l'eau?", "options": ["Oxygène", "Hydrogène", "Azote", "Méthane"], "correct_answer": "Hydrogène", "topic": "Électrolyse de l'eau"}
+        ]
+
+def render_compact_schema(model: BaseModel) -> str:
+    """Squelette JSON minifié d'un modèle, ex. {"question":"str","options":["str"]}, à la place du schéma JSON complet."""
+    type_names = {"string": "str", "boolean": "bool", "integer": "int", "number": "float"}
+    skeleton = {}
+    for name, spec in model.model_json_schema()["properties"].items():
+        if spec.get("type") == "array":
+            skeleton[name] = [type_names.get(spec.get("items", {}).get("type"), "any")]
+        else:
+            skeleton[name] = type_names.get(spec.get("type"), "any")
+    return json.dumps(skeleton, separators=(",", ":"))
+
+@st.cache_resource(show_spinner=False)
+def init_static_prompt_parts() -> dict:
+    """Parties fixes des prompts (descriptions, exemples et schémas JSON sérialisés), calculées une fois par processus."""
+    parts = {}
+    for type_question in ("QCM", "Vrai/Faux", "Ouvert"):
+        target_model, schema_description, example_output = get_target_config(type_question)
+        parts[type_question] = {
+            'schema_description': schema_description,
+            'example_json': json.dumps(example_output, indent=2),
+            'schema_json': json.dumps(target_model.model_json_schema(), indent=2),
+            'example_compact': json.dumps(example_output, ensure_ascii=False, separators=(",", ":")),
+            'schema_compact': render_compact_schema(target_model)
+        }
+    parts['correction_schema_json'] = json.dumps(CorrectionFeedback.model_json_schema(), indent=2)
+    parts['correction_schema_compact'] = render_compact_schema(CorrectionFeedback)
+    parts['difficulty'] = {d: get_difficulty_instructions(d) for d in ("Facile", "Moyen", "Difficile", "Expert")}
+    return parts
+
+STATIC_PROMPT_PARTS = init_static_prompt_parts()
+
+#Prompts versionnés
+
+# "v1" : prompts historiques (schémas indentés) ; "v2" : prompts compacts, parties fixes en tête pour le cache de préfixe.
+PROMPT_TEMPLATE_VERSIONS = ("v1", "v2")
+
+GENERATION_PROMPT_PREFIX = (
+    "Vous êtes un assistant pédagogique expert qui génère des questions d'examen à partir du texte fourni.\n"
+    'Répondez UNIQUEMENT par un objet JSON {"questions":[...]}, sans autre texte ni markdown.'
+)
+
+GRADING_SYSTEM_PROMPT_V2 = (
+    "Vous êtes un correcteur pédagogique expert. Évaluez la réponse de l'utilisateur à une question ouverte.\n"
+    "Répondez UNIQUEMENT par un objet JSON, sans autre texte ni markdown : {schema}\n"
+    "score_percentage : 0 à 100. is_correct : true si score_percentage >= 70. "
+    "feedback_text : explication courte et constructive (ce qui est correct, ce qui manque)."
+)
+
+try:
+    import tiktoken
+    _TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _TOKEN_ENCODING = None
+
+def count_tokens(text: str) -> int:
+    """Nombre de tokens d'un texte : tiktoken (approximation du tokenizer Llama) si installé, sinon estimation par caractères."""
+    if _TOKEN_ENCODING is not None:
+        return len(_TOKEN_ENCODING.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+def build_generation_prompt(difficulty: str, num_questions: int, type_question: str, version: str = PROMPT_VERSION) -> str:
+    """Construit le prompt système de génération pour un type de question et une difficulté."""
+    parts = STATIC_PROMPT_PARTS.get(type_question, STATIC_PROMPT_PARTS["QCM"])
+    schema_description = parts['schema_description']
+    difficulty_instruction = STATIC_PROMPT_PARTS['difficulty'].get(difficulty, "")
+
+    if version == "v2":
+        # Du plus stable au plus variable : préfixe commun, puis type, puis difficulté et nombre.
+        return (
+            f"{GENERATION_PROMPT_PREFIX}\n"
+            f"Type {type_question} : {schema_description}\n"
+            f"Schéma d'une question : {parts['schema_compact']}\n"
+            f"Exemple (format seulement) : {parts['example_compact']}\n"
+            f"Difficulté : {difficulty}. {difficulty_instruction}\n"
+            f"Nombre de questions : exactement {num_questions}."
+        )
+
+    example_output_str = parts['example_json']
+
+    system_prompt = f"""
+    Vous êtes un assistant pédagogique expert générant des questions de type {type_question} ({schema_description}) basées sur le texte fourni.
+    Le niveau de difficulté doit être strictement : {difficulty}. {difficulty_instruction}
+    
+    INSTRUCTION CRITIQUE: Votre sortie DOIT être STRICTEMENT un tableau JSON (JSON array) contenant exactement {num_questions} objets, SANS AUCUN AUTRE TEXTE NI MARKDOWN avant ou après.
+    
+    EXEMPLE DE STRUCTURE ATTENDUE (N'UTILISEZ PAS CE CONTENU, SEULEMENT LE FORMAT):
+    {example_output_str}
+    
+    SCHEMA JSON (POUR RÉFÉRENCE) :
+    {parts['schema_json']}
+    """
+    return system_prompt
+
+def build_generation_user_message(text_source: str, num_questions: int, batch: Optional[Tuple[int, int]] = None) -> str:
+    """Message utilisateur de génération ; `batch` = (numéro, nombre de lots) oriente chaque lot d'un grand examen vers une partie du texte."""
+    if batch is not None and batch[1] > 1:
+        number, count = batch
+        return (
+            f"Générer {num_questions} questions basées sur le texte suivant (lot {number}/{count} d'un grand examen : "
+            f"porter en priorité sur la partie {number} sur {count} du texte, pour ne pas répéter les autres lots) : \n\n{text_source}"
+        )
+    return f"Générer {num_questions} questions basées sur le texte suivant : \n\n{text_source}"
+
+def build_top_up_user_message(text_source: str, num_questions: int, existing_questions: List[BaseModel]) -> str:
+    """Message de complément : ne demande que les questions manquantes, en listant celles à ne pas répéter."""
+    already_asked = "\n".join(f"- {q.question} (thème : {q.topic})" for q in existing_questions)
+    return (
+        f"Générer {num_questions} NOUVELLES questions basées sur le texte suivant, différentes des questions déjà posées "
+        f"et portant de préférence sur d'autres thèmes.\n\nQuestions déjà posées (à ne pas répéter) :\n{already_asked}"
+        f"\n\nTexte : \n\n{text_source}"
+    )
+
+def build_grading_messages(question_text: str, user_answer: str, expected_keywords: List[str], version: str = GRADING_PROMPT_VERSION) -> List[dict]:
+    """Messages de correction d'une question ouverte."""
+    if version == "v2":
+        # Prompt système identique pour toutes les corrections ; seules les données varient dans le message utilisateur.
+        return [
+            {"role": "system", "content": GRADING_SYSTEM_PROMPT_V2.format(schema=STATIC_PROMPT_PARTS['correction_schema_compact'])},
+            {"role": "user", "content": (
+                f"Question : {question_text}\n"
+                f"Mots-clés attendus : {', '.join(expected_keywords)}\n"
+                f"Réponse de l'utilisateur : {user_answer}"
+            )}
+        ]
+
+    system_prompt = f"""
+    Vous êtes un correcteur pédagogique expert. Votre tâche est d'évaluer la justesse d'une réponse utilisateur à une question ouverte.
+    
+    Question : {question_text}
+    Mots-clés attendus (pour référence) : {', '.join(expected_keywords)}
+    Réponse de l'utilisateur : {user_answer}
+    
+    INSTRUCTION CRITIQUE: Votre sortie DOIT être STRICTEMENT un OBJET JSON, SANS AUCUN AUTRE TEXTE NI MARKDOWN avant ou après.
+    Évaluez la réponse et attribuez un score en pourcentage (0-100). Définissez 'is_correct' à True si le score est >= 70.
+    
+    SCHEMA JSON (POUR SORTIE) :
+    {STATIC_PROMPT_PARTS['correction_schema_json']}
+    """
+    return [{"role": "system", "content": system_prompt}]
+
+@dataclass
+class ExtractionReport:
+    """Bilan d'une extraction : éléments validés (récupérés) et objets rejetés (JSON cassé ou validation Pydantic)."""
+    salvaged: int = 0
+    dropped: int = 0
+
+    @property
+    def salvage_rate(self) -> float:
+        total = self.salvaged + self.dropped
+        return self.salvaged / total if total else 0.0
+
+# TypeAdapter(List[Modèle]) précompilés, un par modèle de sortie LLM. Ils ne passent pas par st.cache_resource :
+# les classes Pydantic sont redéfinies à chaque rerun et les adaptateurs doivent correspondre aux classes courantes.
+LIST_ADAPTERS = {model: TypeAdapter(List[model]) for model in (*QUESTION_MODELS.values(), CorrectionFeedback)}
+
+JSON_START_PATTERN = re.compile(r"[\[{]")
+
+def iter_json_values(text: str, report: Optional[ExtractionReport] = None) -> Iterator[object]:
+    """Parcourt le texte en une passe et produit chaque valeur JSON décodable qui commence par '{' ou '['.
+
+    Si une valeur englobante est malformée (ex. un seul objet cassé dans le tableau), le parcours reprend
+    juste après son délimiteur ouvrant, ce qui permet de récupérer individuellement les objets valides qu'elle contient.
+    Les objets indécodables rencontrés dans un tableau malformé sont comptés comme rejetés dans `report`.
+    """
+    decoder = json.JSONDecoder()
+    pos = 0
+    # Vrai une fois entré dans un tableau malformé : un '{' indécodable y est un élément perdu, pas une enveloppe.
+    in_broken_array = False
+    while True:
+        match = JSON_START_PATTERN.search(text, pos)
+        if match is None:
+            return
+        try:
+            value, pos = decoder.raw_decode(text, match.start())
+            yield value
+        except JSONDecodeError:
+            pos = match.start() + 1
+            if match.group() == "[":
+                in_broken_array = True
+            elif in_broken_array and report is not None:
+                report.dropped += 1
+
+def collect_candidate_items(value: object) -> List[dict]:
+    """Objets candidats d'une valeur JSON : éléments d'un tableau, tableaux d'objets d'un dict enveloppe, ou le dict lui-même."""
+    if isinstance(value, list):
+        return [item for item in value if isinstance(item, dict)]
+    if isinstance(value, dict):
+        # Ex. {"questions": [...]} produit par le mode JSON objet de Groq.
+        containers = [v for v in value.values() if isinstance(v, list) and any(isinstance(item, dict) for item in v)]
+        if containers:
+            return [item for container in containers for item in container if isinstance(item, dict)]
+        return [value]
+    return []
+
+def extract_with_report(json_string: str, target_model: BaseModel) -> Tuple[List[BaseModel], ExtractionReport]:
+    """Extrait et valide tous les objets récupérables de la sortie LLM, avec le bilan récupérés/rejetés."""
+    report = ExtractionReport()
+    items = [item for value in iter_json_values(json_string, report) for item in collect_candidate_items(value)]
+    if not items:
+        return [], report
+
+    adapter = LIST_ADAPTERS[target_model]
+    try:
+        valid_items = adapter.validate_python(items)
+    except ValidationError as e:
+        # Une seule validation groupée ; en cas d'erreur on écarte uniquement les indices fautifs.
+        bad_indices = {error['loc'][0] for error in e.errors() if error['loc']}
+        valid_items = adapter.validate_python([item for i, item in enumerate(items) if i not in bad_indices])
+        report.dropped += len(bad_indices)
+    report.salvaged = len(valid_items)
+    return valid_items, report
+
+def extract_and_validate_json(json_string: str, target_model: BaseModel) -> List[BaseModel]:
+    #Nettoie le texte brut du LLM et valide le JSON avec Pydantic.
+    valid_questions, report = extract_with_report(json_string, target_model)
+    if not valid_questions:
+        raise ValueError(f"Aucun objet JSON valide dans la sortie LLM ({report.dropped} rejeté(s) par la validation Pydantic).")
+    return valid_questions
+
+class IncrementalJSONArrayParser:
+    """Extrait au fil de l'eau les objets JSON complets contenus dans un tableau, quel que soit son niveau d'imbrication.
+
+    Permet de valider chaque question dès que son objet `{...}` est fermé, sans attendre la fin de la réponse.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._object_start = None
+        self._object_depth = None
+
+    def feed(self, chunk: str) -> List[dict]:
+        """Ajoute un fragment de texte et retourne les objets terminés dans ce fragment."""
+        self._buffer += chunk
+        objects = []
+        for i in range(self._pos, len(self._buffer)):
+            ch = self._buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '[{':
+                # Début d'un élément de tableau : candidat à l'extraction.
+                if ch == '{' and self._object_start is None and self._stack and self._stack[-1] == '[':
+                    self._object_start = i
+                    self._object_depth = len(self._stack)
+                self._stack.append(ch)
+            elif ch in ']}' and self._stack:
+                self._stack.pop()
+                if self._object_start is not None and ch == '}' and len(self._stack) == self._object_depth:
+                    try:
+                        item = json.loads(self._buffer[self._object_start:i + 1])
+                        if isinstance(item, dict):
+                            objects.append(item)
+                    except JSONDecodeError:
+                        pass
+                    self._object_start = None
+        self._pos = len(self._buffer)
+
+        # Ne conserve que le texte de l'objet en cours pour garder un tampon borné.
+        if self._object_start is None:
+            self._buffer, self._pos = "", 0
+        elif self._object_start > 0:
+            self._buffer = self._buffer[self._object_start:]
+            self._pos -= self._object_start
+            self._object_start = 0
+        return objects
+
+    @property
+    def text(self) -> str:
+        """Texte non encore consommé (objet en cours)."""
+        return self._buffer
+
+#Découpage des textes longs (map-reduce)
+
+# Approximation utilisée pour borner les segments : ~4 caractères par token pour le français.
+CHARS_PER_TOKEN = 4
+CHUNK_MAX_TOKENS = 3000
+CHUNK_OVERLAP_TOKENS = 200
+CHUNK_MAX_WORKERS = 4
+GENERATION_TIMEOUT_S = 60.0
+# Nombre maximal de requêtes complémentaires pour obtenir les questions manquantes.
+MAX_TOP_UP_ROUNDS = 2
+# Questions demandées au plus par appel LLM : au-delà (grands examens), la génération est répartie en lots parallèles.
+GENERATION_BATCH_SIZE = 10
+# Attente maximale d'un lot sur le limiteur : un grand examen attend son quota (30 RPM / 6000 TPM par défaut) au lieu de perdre ses lots.
+GENERATION_BATCH_MAX_WAIT_S = 300.0
+
+def estimate_tokens(text: str) -> int:
+    """Estimation rapide (arrondie au supérieur) du nombre de tokens d'un texte."""
+    return max(1, -(-len(text) // CHARS_PER_TOKEN))
+
+def split_text_into_chunks(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """Découpe le texte en segments bornés en tokens, sur des frontières de phrases, avec recouvrement."""
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+|\n{2,}', text) if s.strip()]
+    # Une phrase plus longue qu'un segment est coupée brutalement.
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    units = [s[i:i + max_chars] for s in sentences for i in range(0, len(s), max_chars)]
+
+    chunks = []
+    current, current_tokens = [], 0
+    for unit in units:
+        # L'espace de jointure est compté pour que le segment final respecte la borne.
+        unit_tokens = estimate_tokens(unit + " ")
+        if current and current_tokens + unit_tokens > max_tokens:
+            chunks.append(" ".join(current))
+            # Reprend les dernières phrases du segment précédent pour ne pas couper une idée en deux.
+            overlap, overlap_size = [], 0
+            for previous in reversed(current):
+                previous_tokens = estimate_tokens(previous + " ")
+                if overlap_size + previous_tokens > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += previous_tokens
+            if overlap_size + unit_tokens > max_tokens:
+                overlap, overlap_size = [], 0
+            current, current_tokens = overlap, overlap_size
+        current.append(unit)
+        current_tokens += unit_tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def allocate_question_quotas(chunks: List[str], num_questions: int) -> List[int]:
+    """Répartit les questions proportionnellement à la taille des segments (arrondi cumulatif, somme exacte)."""
+    sizes = [len(c) for c in chunks]
+    total = sum(sizes) or 1
+    quotas = []
+    cumulated = 0
+    for size in sizes:
+        start = num_questions * cumulated // total
+        cumulated += size
+        quotas.append(num_questions * cumulated // total - start)
+    return quotas
+
+def question_fingerprint(question: BaseModel) -> str:
+    """Forme canonique d'une question (casse et ponctuation ignorées) pour la déduplication."""
+    return " ".join(re.findall(r"\w+", question.question.casefold()))
+
+def merge_chunk_questions(per_chunk_questions: List[List[BaseModel]], num_questions: int) -> List[BaseModel]:
+    """Fusionne les questions des segments en alternant entre eux, supprime les doublons et tronque au nombre demandé."""
+    merged = []
+    seen = set()
+    for rank in range(max((len(qs) for qs in per_chunk_questions), default=0)):
+        for questions in per_chunk_questions:
+            if rank >= len(questions):
+                continue
+            fingerprint = question_fingerprint(questions[rank])
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            merged.append(questions[rank])
+    return merged[:num_questions]
+
+#Import de documents (PDF, DOCX, Markdown, texte)
+
+# Taille maximale d'un fichier importé (Mo) et nombre maximal de caractères extraits par document (au-delà, le texte est tronqué).
+DOCUMENT_MAX_MB = int(ENV.get("AKALEARN_DOCUMENT_MAX_MB", "50"))
+DOCUMENT_MAX_CHARS = int(ENV.get("AKALEARN_DOCUMENT_MAX_CHARS", "1000000"))
+DOCUMENT_TYPES = ("pdf", "docx", "md", "txt")
+DOCUMENT_READ_BLOCK_BYTES = 1 << 20
+# Textes extraits gardés en mémoire pour tout le processus : une seule copie par document, partagée par les sessions.
+DOCUMENT_MEMORY_CACHE_MAX_ENTRIES = 8
+DOCX_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+class DocumentError(Exception):
+    """Document trop volumineux, illisible ou d'un type non pris en charge."""
+
+@dataclass
+class DocumentInfo:
+    """Métadonnées d'un document importé ; le texte lui-même reste dans le cache (get_document_text)."""
+    file_hash: str
+    name: str
+    chars: int
+    truncated: bool
+
+@st.cache_resource(show_spinner=False)
+def init_document_memory_cache():
+    return OrderedDict(), threading.Lock()
+
+_DOCUMENT_MEMORY_CACHE, _DOCUMENT_MEMORY_CACHE_LOCK = init_document_memory_cache()
+
+def _remember_document(file_hash: str, extracted: Tuple[str, bool]) -> None:
+    with _DOCUMENT_MEMORY_CACHE_LOCK:
+        _DOCUMENT_MEMORY_CACHE[file_hash] = extracted
+        _DOCUMENT_MEMORY_CACHE.move_to_end(file_hash)
+        while len(_DOCUMENT_MEMORY_CACHE) > DOCUMENT_MEMORY_CACHE_MAX_ENTRIES:
+            _DOCUMENT_MEMORY_CACHE.popitem(last=False)
+
+def get_extracted_document(file_hash: str) -> Optional[Tuple[str, bool]]:
+    """(texte, tronqué) d'un document déjà importé, cherché en mémoire puis sur disque ; None s'il faut le réimporter."""
+    with _DOCUMENT_MEMORY_CACHE_LOCK:
+        extracted = _DOCUMENT_MEMORY_CACHE.get(file_hash)
+        if extracted is not None:
+            _DOCUMENT_MEMORY_CACHE.move_to_end(file_hash)
+            return extracted
+    try:
+        with closing(open_cache_db()) as conn:
+            row = conn.execute(
+                "SELECT text, truncated FROM document_text WHERE file_hash = ? AND max_chars = ?", (file_hash, DOCUMENT_MAX_CHARS)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    if row is None:
+        return None
+    extracted = (row[0], bool(row[1]))
+    _remember_document(file_hash, extracted)
+    return extracted
+
+def get_document_text(file_hash: str) -> Optional[str]:
+    """Texte extrait d'un document déjà importé ; None s'il faut le réimporter."""
+    extracted = get_extracted_document(file_hash)
+    return extracted[0] if extracted is not None else None
+
+def store_document_text(file_hash: str, text: str, truncated: bool) -> None:
+    _remember_document(file_hash, (text, truncated))
+    now = time.time()
+    try:
+        with closing(open_cache_db()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO document_text (file_hash, max_chars, text, truncated, created_at) VALUES (?, ?, ?, ?, ?)",
+                (file_hash, DOCUMENT_MAX_CHARS, text, int(truncated), now)
+            )
+            conn.execute("DELETE FROM document_text WHERE created_at < ?", (now - GENERATION_CACHE_TTL_S,))
+    except sqlite3.Error:
+        pass
+
+def hash_stream(stream) -> str:
+    """SHA-256 du contenu, lu par blocs (le fichier n'est jamais copié en entier)."""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for block in iter(lambda: stream.read(DOCUMENT_READ_BLOCK_BYTES), b""):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def iter_plain_text(stream) -> Iterator[str]:
+    """Texte brut ou Markdown décodé par blocs (UTF-8, BOM toléré, octets invalides remplacés)."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    for block in iter(lambda: stream.read(DOCUMENT_READ_BLOCK_BYTES), b""):
+        yield decoder.decode(block)
+    yield decoder.decode(b"", final=True)
+
+def iter_pdf_pages(stream) -> Iterator[str]:
+    """Texte d'un PDF, page par page (les pages sont chargées à la demande par pypdf)."""
+    if pypdf is None:
+        raise DocumentError("L'import de PDF nécessite pypdf : pip install pypdf")
+    try:
+        for page in pypdf.PdfReader(stream).pages:
+            yield (page.extract_text() or "") + "\n\n"
+    except pypdf.errors.PyPdfError as e:
+        raise DocumentError(f"PDF illisible : {e}") from e
+
+def iter_docx_paragraphs(stream) -> Iterator[str]:
+    """Texte d'un DOCX, paragraphe par paragraphe, en parcourant word/document.xml sans le charger en entier."""
+    try:
+        with zipfile.ZipFile(stream) as archive, archive.open("word/document.xml") as document_xml:
+            for _, element in ElementTree.iterparse(document_xml):
+                if element.tag == DOCX_NAMESPACE + "p":
+                    yield "".join(node.text or "" for node in element.iter(DOCX_NAMESPACE + "t")) + "\n"
+                    element.clear()
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        raise DocumentError(f"DOCX illisible : {e}") from e
+
+DOCUMENT_READERS = {"pdf": iter_pdf_pages, "docx": iter_docx_paragraphs, "md": iter_plain_text, "txt": iter_plain_text}
+
+def extract_document_text(stream, name: str) -> Tuple[str, bool]:
+    """Extrait le texte d'un document au fil de la lecture ; s'arrête à DOCUMENT_MAX_CHARS (texte tronqué : True)."""
+    extension = os.path.splitext(name)[1].lower().lstrip(".")
+    if extension not in DOCUMENT_READERS:
+        raise DocumentError(f"Type de fichier non pris en charge : {name} (formats acceptés : {', '.join(DOCUMENT_TYPES)}).")
+    parts = []
+    size = 0
+    for piece in DOCUMENT_READERS[extension](stream):
+        if size + len(piece) > DOCUMENT_MAX_CHARS:
+            parts.append(piece[:DOCUMENT_MAX_CHARS - size])
+            return "".join(parts).strip(), True
+        parts.append(piece)
+        size += len(piece)
+    return "".join(parts).strip(), False
+
+def ingest_document(stream, name: str) -> Tuple[DocumentInfo, str]:
+    """Importe un document (flux binaire repositionnable) : un fichier déjà vu (même empreinte) n'est pas réextrait."""
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    if size > DOCUMENT_MAX_MB * 1024 * 1024:
+        raise DocumentError(f"{name} dépasse la taille maximale de {DOCUMENT_MAX_MB} Mo.")
+    file_hash = hash_stream(stream)
+    extracted = get_extracted_document(file_hash)
+    if extracted is None:
+        extracted = extract_document_text(stream, name)
+        if not extracted[0]:
+            raise DocumentError(f"Aucun texte n'a pu être extrait de {name} (document scanné ou vide ?).")
+        store_document_text(file_hash, *extracted)
+    text, truncated = extracted
+    return DocumentInfo(file_hash, name, len(text), truncated), text
+
+class MappedFile(io.RawIOBase):
+    """Flux en lecture sur un fichier projeté en mémoire (mmap n'expose pas seekable() avant Python 3.13, requis par zipfile)."""
+
+    def __init__(self, mapped: mmap.mmap):
+        self._mapped = mapped
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._mapped.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._mapped.seek(offset, whence)
+        return self._mapped.tell()
+
+    def tell(self) -> int:
+        return self._mapped.tell()
+
+def ingest_document_file(path: str) -> Tuple[DocumentInfo, str]:
+    """Importe un fichier du disque, projeté en mémoire (mmap) : seules les pages lues sont chargées."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise DocumentError(f"{path} est vide.")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return ingest_document(MappedFile(mapped), os.path.basename(path))
+
+#Pré-compression extractive du texte source
+
+# Budget de tokens du texte envoyé au LLM (0 : pas de coupe) ; au-delà, seules les phrases les plus denses en notions clés sont gardées.
+SOURCE_TOKEN_BUDGET = int(ENV.get("AKALEARN_SOURCE_TOKEN_BUDGET", "6000"))
+# Budget supplémentaire par question demandée : un grand examen garde assez de texte pour que le découpage couvre tout le document.
+SOURCE_TOKENS_PER_QUESTION = 600
+# Similarité (Jaccard sur les racines des mots) au-delà de laquelle deux paragraphes sont des doublons.
+PARAGRAPH_DUPLICATE_SIMILARITY = 0.9
+
+PARAGRAPH_PATTERN = re.compile(r"(?:[^\n]|\n(?![ \t]*\n))+")
+# Une ponctuation finale n'arrête la phrase que suivie d'un blanc (nombres, URL et noms de fichiers restent entiers) ;
+# une fin de ligne sépare aussi deux phrases : titres, puces et en-têtes sont des unités à part.
+SENTENCE_PATTERN = re.compile(r"(?:[^.!?\n]|[.!?](?![.!?]*(?:\s|$)))+[.!?]*")
+
+@dataclass
+class CompressedSource:
+    """Texte réduit envoyé au LLM et position (début, fin) dans le texte d'origine de chaque phrase gardée."""
+    text: str
+    spans: List[Tuple[int, int]]
+    original_tokens: int
+    kept_tokens: int
+    duplicate_paragraphs: int = 0
+
+def iter_sentence_spans(text: str, start: int, end: int) -> Iterator[Tuple[int, int]]:
+    """Positions des phrases non vides de text[start:end], espaces de bord exclus."""
+    for match in SENTENCE_PATTERN.finditer(text, start, end):
+        sentence = match.group()
+        left = len(sentence) - len(sentence.lstrip())
+        right = len(sentence.rstrip())
+        if right > left:
+            yield match.start() + left, match.start() + right
+
+def is_similar_paragraph(stems: frozenset, other: frozenset) -> bool:
+    # Filtre rapide : la similarité de Jaccard ne peut dépasser le rapport des tailles.
+    if min(len(stems), len(other)) < PARAGRAPH_DUPLICATE_SIMILARITY * max(len(stems), len(other)):
+        return False
+    return len(stems & other) >= PARAGRAPH_DUPLICATE_SIMILARITY * len(stems | other)
+
+def find_duplicate_paragraphs(paragraph_stems: List[frozenset]) -> set:
+    """Indices des paragraphes (quasi) identiques à un paragraphe précédent gardé.
+
+    Filtrage par préfixe : les racines de chaque paragraphe sont triées de la plus rare à la plus fréquente, et deux
+    paragraphes assez similaires partagent forcément une racine parmi les premières. Seules ces paires sont comparées :
+    le coût reste quasi linéaire en nombre de paragraphes, pour le même résultat qu'une comparaison deux à deux.
+    """
+    frequency = Counter(stem for stems in paragraph_stems for stem in stems)
+    # Racine -> paragraphes gardés dont le préfixe la contient.
+    prefix_index = {}
+    duplicates = set()
+    for i, stems in enumerate(paragraph_stems):
+        prefix_length = len(stems) - int(PARAGRAPH_DUPLICATE_SIMILARITY * len(stems)) + 1
+        prefix = sorted(stems, key=lambda stem: (frequency[stem], stem))[:prefix_length]
+        candidates = {j for stem in prefix for j in prefix_index.get(stem, ())}
+        if any(is_similar_paragraph(stems, paragraph_stems[j]) for j in candidates):
+            duplicates.add(i)
+            continue
+        for stem in prefix:
+            prefix_index.setdefault(stem, []).append(i)
+    return duplicates
+
+def score_sentences(sentences: List[str]) -> List[float]:
+    """Densité en notions clés de chaque phrase (TF-IDF) : poids des racines distinctes rapporté à la longueur de la phrase.
+
+    Une notion clé revient souvent dans le document (tf élevé) sans être présente dans toutes les phrases (idf élevé).
+    """
+    sentence_stems = [normalize_for_pregrade(s) for s in sentences]
+    term_frequency = Counter(stem for stems in sentence_stems for stem in stems)
+    document_frequency = Counter(stem for stems in sentence_stems for stem in set(stems))
+    count = len(sentences)
+    weight = {stem: (1 + math.log(tf)) * math.log(1 + count / document_frequency[stem]) for stem, tf in term_frequency.items()}
+    return [
+        sum(weight[stem] for stem in set(stems)) / math.sqrt(len(sentence.split()))
+        for sentence, stems in zip(sentences, sentence_stems)
+    ]
+
+def source_token_budget(num_questions: int) -> int:
+    """Budget de tokens du texte source pour un examen : SOURCE_TOKEN_BUDGET, relevé proportionnellement au nombre de questions."""
+    if SOURCE_TOKEN_BUDGET <= 0:
+        return 0
+    return max(SOURCE_TOKEN_BUDGET, num_questions * SOURCE_TOKENS_PER_QUESTION)
+
+def compress_source_text(text_source: str, token_budget: int = SOURCE_TOKEN_BUDGET) -> CompressedSource:
+    """Retire les paragraphes (quasi) dupliqués puis, si le texte dépasse `token_budget`, garde les phrases les plus denses.
+
+    Les phrases gardées restent dans leur ordre d'origine. Un texte sans doublon et dans le budget est renvoyé tel quel.
+    """
+    original_tokens = estimate_tokens(text_source)
+    matches = []
+    paragraph_stems = []
+    for match in PARAGRAPH_PATTERN.finditer(text_source):
+        stems = frozenset(normalize_for_pregrade(match.group()))
+        if stems:
+            matches.append(match)
+            paragraph_stems.append(stems)
+    duplicate_indices = find_duplicate_paragraphs(paragraph_stems)
+    duplicates = len(duplicate_indices)
+    paragraphs = [
+        list(iter_sentence_spans(text_source, match.start(), match.end()))
+        for i, match in enumerate(matches) if i not in duplicate_indices
+    ]
+
+    if not duplicates and (token_budget <= 0 or original_tokens <= token_budget):
+        # Texte inchangé : les positions des phrases servent quand même à retrouver l'origine des questions.
+        return CompressedSource(text_source, [span for spans in paragraphs for span in spans], original_tokens, original_tokens)
+
+    # (paragraphe, début, fin) de chaque phrase, dans l'ordre du texte.
+    sentences = [(p, start, end) for p, spans in enumerate(paragraphs) for start, end in spans]
+    selected = set(range(len(sentences)))
+    if token_budget > 0 and sum(estimate_tokens(text_source[s:e] + " ") for _, s, e in sentences) > token_budget:
+        scores = score_sentences([text_source[s:e] for _, s, e in sentences])
+        selected, used = set(), 0
+        for i in sorted(range(len(sentences)), key=lambda i: scores[i], reverse=True):
+            sentence_tokens = estimate_tokens(text_source[sentences[i][1]:sentences[i][2]] + " ")
+            if used + sentence_tokens <= token_budget:
+                selected.add(i)
+                used += sentence_tokens
+
+    parts = []
+    spans = []
+    previous_paragraph = None
+    for i, (paragraph, start, end) in enumerate(sentences):
+        if i not in selected:
+            continue
+        if parts:
+            parts.append(" " if paragraph == previous_paragraph else "\n\n")
+        parts.append(text_source[start:end])
+        spans.append((start, end))
+        previous_paragraph = paragraph
+    text = "".join(parts)
+    return CompressedSource(text, spans, original_tokens, estimate_tokens(text), duplicates)
+
+def trace_question_sources(original_text: str, compressed: CompressedSource, questions: List[BaseModel]) -> List[Optional[Tuple[int, int]]]:
+    """Position (début, fin) dans le texte d'origine du passage dont vient chaque question ; None sans recoupement.
+
+    Le passage retenu est la phrase gardée qui partage le plus de racines avec le thème et l'énoncé de la question.
+    """
+    # Racine -> phrases gardées qui la contiennent.
+    index = {}
+    for i, (start, end) in enumerate(compressed.spans):
+        for stem in set(normalize_for_pregrade(original_text[start:end])):
+            index.setdefault(stem, []).append(i)
+    sources = []
+    for question in questions:
+        stems = set(normalize_for_pregrade(f"{question.topic} {question.question}"))
+        hits = Counter(i for stem in stems for i in index.get(stem, ()))
+        if not hits:
+            sources.append(None)
+            continue
+        # À égalité, la première phrase du texte.
+        best = max(hits, key=lambda i: (hits[i], -i))
+        sources.append(compressed.spans[best])
+    return sources
+
+#Génération des questions
+
+def request_questions(text_source: str, difficulty: str, num_questions: int, type_question: str, temperature: float, notify: bool = True, existing_questions: Optional[List[BaseModel]] = None, batch: Optional[Tuple[int, int]] = None, max_wait_s: Optional[float] = None) -> List[BaseModel]:
+    """Un appel de génération avec retries ; retourne [] en cas d'échec.
+
+    Avec `existing_questions`, la requête est un complément qui exclut les questions déjà obtenues.
+    `max_wait_s` borne l'attente du quota (voir call_llm).
+    """
+    target_model, _, _ = get_target_config(type_question)
+    system_prompt = build_generation_prompt(difficulty, num_questions, type_question)
+    if existing_questions:
+        user_message = build_top_up_user_message(text_source, num_questions, existing_questions)
+    else:
+        user_message = build_generation_user_message(text_source, num_questions, batch)
+    
+    def report_retry(attempt, error, wait):
+        if notify:
+            st.warning(f"Erreur LLM/Pydantic (Tentative n°{attempt+1} échouée : {error}). Nouvelle tentative dans {wait:.1f}s...")
+
+    MAX_RETRIES = 3
+    #Retry pour tolérer les erreurs de formatage JSON du LLM (uniquement si aucune question n'est récupérable).
+    try:
+        return call_llm(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            temperature=temperature,
+            max_retries=MAX_RETRIES,
+            timeout=GENERATION_TIMEOUT_S,
+            response_model=target_model,
+            on_retry=report_retry,
+            call_site="generation_complement" if existing_questions else "generation",
+            difficulty=difficulty,
+            max_wait_s=max_wait_s,
+            response_format={"type": "json_object"}
+        )
+    except Exception as e:
+        if notify:
+            st.error(f"Échec de la génération pour cause d'erreur LLM : {e}")
+            st.error("Échec critique de la génération JSON structurée. Simplifiez le texte source, augmentez la température, ou vérifiez la clé API.")
+        return []
+
+def top_up_questions(text_source: str, difficulty: str, num_questions: int, type_question: str, temperature: float, questions: List[BaseModel], max_wait_s: Optional[float] = None) -> List[BaseModel]:
+    """Complète une liste partielle par de petites requêtes qui ne demandent que les questions manquantes.
+
+    Les questions déjà valides sont conservées : le coût d'un complément est proportionnel à ce qui manque.
+    """
+    questions = merge_chunk_questions([questions], num_questions)
+    for _ in range(MAX_TOP_UP_ROUNDS):
+        missing = num_questions - len(questions)
+        if missing <= 0 or not questions:
+            break
+        extra = request_questions(text_source, difficulty, missing, type_question, temperature, notify=False, existing_questions=questions, max_wait_s=max_wait_s)
+        seen = {question_fingerprint(q) for q in questions}
+        new_questions = [q for q in extra if question_fingerprint(q) not in seen][:missing]
+        if not new_questions:
+            break
+        questions = questions + new_questions
+    return questions
+
+def generate_questions_for_text(text_source: str, difficulty: str, num_questions: int, type_question: str, temperature: float, notify: bool = True, batch: Optional[Tuple[int, int]] = None, max_wait_s: Optional[float] = None) -> List[BaseModel]:
+    """Génère les questions pour un seul texte (ou segment), complétées si le modèle en a produit trop peu ; [] en cas d'échec.
+
+    `notify=False` désactive les messages Streamlit (appel depuis un thread de génération).
+    """
+    questions = request_questions(text_source, difficulty, num_questions, type_question, temperature, notify=notify, batch=batch, max_wait_s=max_wait_s)
+    return top_up_questions(text_source, difficulty, num_questions, type_question, temperature, questions, max_wait_s)
+
+def stream_questions(text_source: str, difficulty: str, num_questions: int, type_question: str, temperature: float) -> Iterator[BaseModel]:
+    """Génère les questions en streaming et produit chacune dès que son objet JSON est fermé et validé.
+
+    Pas de retry ici : l'appelant se replie sur la génération classique si rien n'a été produit.
+    """
+    target_model, _, _ = get_target_config(type_question)
+    system_prompt = build_generation_prompt(difficulty, num_questions, type_question)
+
+    # Le mode JSON de Groq n'est pas compatible avec le streaming : le format est imposé par le prompt seul.
+    stream = call_llm(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": build_generation_user_message(text_source, num_questions)}
+        ],
+        temperature=temperature,
+        max_retries=1,
+        timeout=GENERATION_TIMEOUT_S,
+        call_site="generation_streaming",
+        difficulty=difficulty,
+        stream=True
+    )
+
+    parser = IncrementalJSONArrayParser()
+    seen = set()
+    produced = 0
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            for item in parser.feed(chunk.choices[0].delta.content or ""):
+                try:
+                    question = target_model(**item)
+                except ValidationError:
+                    continue
+                fingerprint = question_fingerprint(question)
+                if fingerprint in seen:
+                    continue
+                seen.add(fingerprint)
+                produced += 1
+                yield question
+                if produced >= num_questions:
+                    return
+    finally:
+        stream.close()
+
+def split_into_batches(num_questions: int, batch_size: int = GENERATION_BATCH_SIZE) -> List[int]:
+    """Tailles de lots équilibrées, chacune au plus `batch_size` (ex. 25 -> [9, 8, 8])."""
+    count = max(1, -(-num_questions // batch_size))
+    return [num_questions // count + (1 if i < num_questions % count else 0) for i in range(count)]
+
+def generate_questions_chunked(chunks: List[str], difficulty: str, num_questions: int, type_question: str, temperature: float, notify: bool = True) -> List[BaseModel]:
+    """Génère en parallèle les questions de chaque segment selon son quota, par lots de GENERATION_BATCH_SIZE, puis fusionne les résultats.
+
+    Les lots attendent leur quota (jusqu'à GENERATION_BATCH_MAX_WAIT_S) ; le manque global après fusion est complété segment par segment.
+    """
+    quotas = allocate_question_quotas(chunks, num_questions)
+    # Un lot par tranche de GENERATION_BATCH_SIZE questions : (indice du lot, segment, quota, (numéro, nombre de lots du segment)).
+    jobs = []
+    for chunk, quota in zip(chunks, quotas):
+        if quota <= 0:
+            continue
+        sizes = split_into_batches(quota)
+        jobs.extend((len(jobs), chunk, size, (number, len(sizes))) for number, size in enumerate(sizes, start=1))
+    per_batch_questions = [[] for _ in jobs]
+
+    with ThreadPoolExecutor(max_workers=min(CHUNK_MAX_WORKERS, len(jobs))) as executor:
+        futures = {
+            submit_with_context(executor, generate_questions_for_text, chunk, difficulty, size, type_question, temperature, False, batch, GENERATION_BATCH_MAX_WAIT_S): i
+            for i, chunk, size, batch in jobs
+        }
+        for future in as_completed(futures):
+            per_batch_questions[futures[future]] = future.result()
+
+    questions = merge_chunk_questions(per_batch_questions, num_questions)
+    # Lots perdus ou doublons écartés à la fusion : le manque est redemandé par petits compléments (hors questions déjà
+    # obtenues), en commençant par les segments dont un lot a échoué.
+    failed_chunks = [chunk for i, chunk, _, _ in jobs if not per_batch_questions[i]]
+    for chunk in dict.fromkeys(failed_chunks + list(chunks)):
+        if len(questions) >= num_questions:
+            break
+        target = min(num_questions, len(questions) + GENERATION_BATCH_SIZE)
+        questions = top_up_questions(chunk, difficulty, target, type_question, temperature, questions, GENERATION_BATCH_MAX_WAIT_S)
+
+    if failed_chunks and notify:
+        st.warning(f"Attention : {len(failed_chunks)} lot(s) sur {len(jobs)} n'ont produit aucune question valide.")
+    return questions
+
+def generate_questions(text_source: str, difficulty: str, num_questions: int, type_question: str, temperature: float, use_cache: bool = True, on_question: Optional[Callable[[BaseModel], None]] = None, notify: bool = True) -> List[BaseModel]:
+    """Point d'entrée de la génération : cache, découpage des textes longs, streaming optionnel.
+
+    Si `on_question` est fourni, il est appelé pour chaque question dès qu'elle est validée (mode streaming).
+    `notify=False` désactive les messages Streamlit (génération depuis un thread d'arrière-plan).
+    """
+    if not LLM_PROVIDERS:
+        return []
+
+    # Un examen identique déjà généré est servi depuis le disque, sans appel réseau.
+    cache_key = generation_cache_key(text_source, difficulty, num_questions, type_question, temperature)
+    if use_cache:
+        cached_questions = get_cached_questions(cache_key)
+        if cached_questions:
+            if notify:
+                st.info("Examen récupéré depuis le cache local (aucun appel LLM).")
+            return cached_questions
+
+    # Questions déjà validées pour ce texte : l'examen est d'abord assemblé depuis la banque.
+    source_fp = source_fingerprint(text_source)
+    bank_questions = draw_from_question_bank(source_fp, difficulty, num_questions, type_question) if use_cache else []
+    if len(bank_questions) >= num_questions:
+        if notify:
+            st.info("Examen assemblé depuis la banque de questions (aucun appel LLM).")
+        return bank_questions
+
+    # Paragraphes répétés retirés et texte ramené au budget de tokens de l'examen : seule la partie informative est envoyée au LLM.
+    compressed = compress_source_text(text_source, source_token_budget(num_questions))
+    if notify and compressed.kept_tokens < compressed.original_tokens:
+        st.caption(f"Texte source compressé localement : ~{compressed.original_tokens} → ~{compressed.kept_tokens} tokens.")
+    original_text = text_source
+    text_source = compressed.text
+
+    # Les textes longs sont découpés pour rester sous la limite de contexte et couvrir tout le document.
+    chunks = split_text_into_chunks(text_source)
+    # Un seul appel suffit pour un texte court et un examen d'au plus GENERATION_BATCH_SIZE questions ; sinon, lots parallèles.
+    single_call = len(chunks) == 1 and num_questions <= GENERATION_BATCH_SIZE
+    if bank_questions:
+        # Seules les questions manquantes sont générées, en excluant celles déjà tirées de la banque.
+        if on_question is not None:
+            for question in bank_questions:
+                on_question(question)
+        if len(chunks) == 1 and num_questions - len(bank_questions) <= GENERATION_BATCH_SIZE:
+            questions = top_up_questions(text_source, difficulty, num_questions, type_question, temperature, bank_questions)
+        else:
+            extra = generate_questions_chunked(chunks, difficulty, num_questions - len(bank_questions), type_question, temperature, notify)
+            questions = merge_chunk_questions([bank_questions + extra], num_questions)
+        if on_question is not None:
+            for question in questions[len(bank_questions):]:
+                on_question(question)
+        if notify:
+            st.info(f"{len(bank_questions)} question(s) tirée(s) de la banque, {len(questions) - len(bank_questions)} générée(s).")
+    elif single_call and on_question is not None:
+        questions = []
+        try:
+            for question in stream_questions(text_source, difficulty, num_questions, type_question, temperature):
+                questions.append(question)
+                on_question(question)
+        except Exception as e:
+            if notify:
+                st.warning(f"Streaming interrompu après {len(questions)} question(s) : {e}")
+        if not questions:
+            questions = generate_questions_for_text(text_source, difficulty, num_questions, type_question, temperature, notify)
+        elif len(questions) < num_questions:
+            # Complément ciblé : seules les questions manquantes sont demandées, puis affichées à leur tour.
+            streamed_count = len(questions)
+            questions = top_up_questions(text_source, difficulty, num_questions, type_question, temperature, questions)
+            for question in questions[streamed_count:]:
+                on_question(question)
+    elif single_call:
+        questions = generate_questions_for_text(text_source, difficulty, num_questions, type_question, temperature, notify)
+    else:
+        questions = generate_questions_chunked(chunks, difficulty, num_questions, type_question, temperature, notify)
+
+    if not questions:
+        return []
+
+    # Chaque question garde la position de son passage dans le texte d'origine (les spans de la compression).
+    store_in_question_bank(source_fp, difficulty, questions, trace_question_sources(original_text, compressed, questions))
+    if len(questions) < num_questions:
+         if notify:
+             st.warning(f"Attention : Le modèle a généré seulement {len(questions)} questions valides au lieu de {num_questions} demandées.")
+    else:
+         # Seuls les examens complets sont mis en cache.
+         store_cached_questions(cache_key, questions)
+
+    return questions
+
+#Service de génération partagé (file de tâches, coalescence des requêtes identiques)
+
+# Générations exécutées simultanément pour tout le processus, toutes sessions confondues ; les suivantes attendent leur tour.
+GENERATION_MAX_CONCURRENT_JOBS = 4
+# Durée de conservation d'une tâche terminée (pour les sessions qui la consultent encore).
+GENERATION_JOB_RETENTION_S = 600.0
+GENERATION_JOB_POLL_S = 0.2
+
+@dataclass
+class GenerationJob:
+    """Tâche de génération partagée : état, questions reçues au fil de l'eau et résultat final."""
+    job_id: str
+    key: str
+    status: str = "en attente"
+    questions: List[BaseModel] = field(default_factory=list)
+    result: Optional[List[BaseModel]] = None
+    error: Optional[str] = None
+    # Demandes en attente du résultat ; à zéro, la tâche est annulée (cancelled).
+    subscribers: int = 1
+    finished_at: Optional[float] = None
+    done: threading.Event = field(default_factory=threading.Event)
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+class GenerationJobService:
+    """File de génération commune à toutes les sessions : pool borné et coalescence (singleflight).
+
+    Deux demandes identiques pendant qu'une génération est en cours partagent la même tâche, donc le même appel LLM.
+    """
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="akalearn-generation")
+        self._jobs = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, work: Callable[[GenerationJob], List[BaseModel]]) -> str:
+        """Identifiant de la tâche en cours pour `key`, ou d'une nouvelle tâche exécutant `work(job)`."""
+        with self._lock:
+            self._purge()
+            job_id = self._in_flight.get(key)
+            if job_id is not None:
+                self._jobs[job_id].subscribers += 1
+                return job_id
+            job = GenerationJob(job_id=uuid.uuid4().hex, key=key)
+            self._jobs[job.job_id] = job
+            self._in_flight[key] = job.job_id
+        submit_with_context(self._executor, self._run, job, work)
+        return job.job_id
+
+    def unsubscribe(self, job_id: str) -> None:
+        """Retire une demande ; sans plus aucune demande, la tâche est annulée et une demande identique ultérieure repart de zéro.
+
+        Une tâche en attente se termine sans rien générer ; une tâche en cours s'arrête avant son prochain appel LLM.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished_at is not None:
+                return
+            job.subscribers -= 1
+            if job.subscribers > 0:
+                return
+            job.cancelled.set()
+            if self._in_flight.get(job.key) == job_id:
+                del self._in_flight[job.key]
+
+    def _run(self, job: GenerationJob, work: Callable[[GenerationJob], List[BaseModel]]) -> None:
+        job.status = "en cours"
+        # Les appels LLM de la tâche (lots, compléments, retries) vérifient ce signal avant de partir.
+        GENERATION_CANCEL_EVENT.set(job.cancelled)
+        try:
+            if job.cancelled.is_set():
+                job.result = []
+            else:
+                job.result = work(job)
+            job.status = "annulé" if job.cancelled.is_set() else "terminé"
+        except Exception as e:
+            job.result = []
+            job.error = str(e)
+            job.status = "échec"
+        finally:
+            with self._lock:
+                # Une tâche annulée a déjà cédé sa clé : ne pas retirer celle d'une nouvelle tâche identique.
+                if self._in_flight.get(job.key) == job.job_id:
+                    del self._in_flight[job.key]
+                job.finished_at = time.monotonic()
+            job.done.set()
+
+    def _purge(self) -> None:
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and time.monotonic() - job.finished_at > GENERATION_JOB_RETENTION_S
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+@st.cache_resource(show_spinner=False)
+def init_generation_jobs() -> GenerationJobService:
+    return GenerationJobService(GENERATION_MAX_CONCURRENT_JOBS)
 
-if GROQ_API_KEY:
-    try:
-        LLM_CLIENT = Groq(api_key=GROQ_API_KEY)
-        LLM_MODEL = "llama-3.1-8b-instant"  
-    except Exception as e:
-        LLM_CLIENT = None
-        st.error(f"ERREUR d'initialisation du client Groq : {e}")
-else:
-    LLM_CLIENT = None
-    st.error(
-        "ERREUR: La clé 'GROQ_API_KEY' est manquante.\n"
-        "Veuillez définir la variable d'environnement GROQ_API_KEY dans le fichier .env."
-    )
+GENERATION_JOBS = init_generation_jobs()
 
-#Config difficulte
-def get_difficulty_instructions(difficulty: str) -> str:
-    """Fournit des instructions spécifiques au LLM pour moduler la complexité cognitive."""
-    if difficulty == "Facile":
-        return "Les questions doivent se concentrer sur les définitions et les faits directement cités, ne nécessitant aucune inférence."
-    elif difficulty == "Moyen":
-        return "Les questions doivent porter sur la compréhension des relations de cause à effet et l'application simple des concepts décrits."
-    elif difficulty == "Difficile":
-        return "Les questions doivent exiger la synthèse de plusieurs idées, la justification d'un processus, ou l'interprétation de données non explicites."
-    elif difficulty == "Expert":
-        return "Les questions doivent nécessiter une analyse critique approfondie, une comparaison d'éléments ou une extrapolation des conséquences au-delà du texte immédiat."
-    return ""
-#Fonctions génération et validation ---
+def submit_generation_job(params: tuple, stream: bool = False) -> str:
+    """Met en file la génération d'un examen (paramètres de generate_questions) et retourne l'identifiant de la tâche.
 
-def get_target_config(type_question: str):
-    if type_question == "Vrai/Faux":
-        return VraiFauxQuestion, "VRAI/FAUX : chaque question doit être une affirmation à laquelle on répond par True ou False.", [
-            {"question": "L'eau bout à 100 degrés Celsius au niveau de la mer.", "correct_answer": True, "topic": "Point d'ébullition"}
-        ]
-    elif type_question == "Ouvert":
-        return QuestionOuverte, "OUVERTE : chaque question doit nécessiter une réponse courte. Le champ 'keywords' doit contenir les éléments de correction.", [
-            {"question": "Quelle est la formule chimique de l'eau?", "keywords": ["H2O", "hydrogène", "oxygène"], "topic": "Formule chimique"}
-        ]
-    else: 
-        return MCQQuestion, "QCM : chaque question doit avoir 4 options (options), dont une seule est la bonne (correct_answer).", [
-            {"question": "Quel gaz est produit à la cathode lors de l'électrolyse de l'eau?", "options": ["Oxygène", "Hydrogène", "Azote", "Méthane"], "correct_answer": "Hydrogène", "topic": "Électrolyse de l'eau"}
-        ]
+    Avec `stream`, les questions validées sont ajoutées à `job.questions` au fur et à mesure.
+    """
+    text_source, difficulty, num_questions, type_question, temperature, use_cache = params
+    key = json.dumps([generation_cache_key(text_source, difficulty, num_questions, type_question, temperature), use_cache])
 
-def extract_and_validate_json(json_string: str, target_model: BaseModel) -> List[BaseModel]:
-    #Nettoie le texte brut du LLM et valide le JSON avec Pydantic.
-    try:
-        # Tente d'isoler le tableau JSON ([...]).
-        start_index = json_string.find('[')
-        end_index = json_string.rfind(']')
-        
-        # Gère les cas où le LLM produit un objet ({...}) au lieu d'un tableau ou une structure non conforme.
-        if start_index == -1 or end_index == -1 or end_index <= start_index:
-            if json_string.strip().startswith('{') and target_model != CorrectionFeedback:
-                 try:
-                    data = json.loads(json_string)
-                    if isinstance(data, dict):
-                         data = [data] 
-                    else:
-                         raise ValueError
-                 except (json.JSONDecodeError, ValueError):
-                      raise ValueError("Délimiteurs JSON ([...] ou {...}) non trouvés ou structure non conforme.")
-            # Cas spécifique pour la correction (un seul objet de feedback attendu).
-            elif target_model == CorrectionFeedback:
-                data = json.loads(json_string)
-                if not isinstance(data, dict):
-                    raise ValueError("Sortie JSON invalide : Le contenu n'est pas un objet (dict).")
-                valid_feedback = target_model(**data)
-                return [valid_feedback] 
-            else:
-                 raise ValueError("Délimiteurs de tableau JSON ([...]) non trouvés.")
-        else:
-            # Coupe le texte pour ne garder que le tableau JSON propre.
-            json_to_parse = json_string[start_index : end_index + 1]
-            data = json.loads(json_to_parse)
+    def work(job: GenerationJob) -> List[BaseModel]:
+        return generate_questions(*params, on_question=job.questions.append if stream else None, notify=False)
 
-    except (json.JSONDecodeError, ValueError) as e:
-        raise ValueError(f"Erreur de décodage JSON : {e}. Sortie LLM brute non conforme au format JSON.")
-    
-    if not isinstance(data, list):
-        if isinstance(data, dict):
-             data = next((v for k, v in data.items() if isinstance(v, list)), data)
-        
-        if not isinstance(data, list):
-             raise ValueError("Sortie JSON invalide : Le contenu n'est pas un tableau (list) principal.")
-    
-    valid_questions = []
-    
-    # Valide élément de la liste avec le modèle Pydantic attendu.
-    for item in data:
-        if not isinstance(item, dict):
-             continue
-        try:
-            valid_questions.append(target_model(**item))
-        except ValidationError:
-             continue
+    return GENERATION_JOBS.submit(key, work)
 
-    if not valid_questions:
-        raise ValueError("Aucun mapping valide trouvé après le filtrage Pydantic.")
-        
-    return valid_questions
+def wait_for_generation_job(job_id: str, on_question: Optional[Callable[[BaseModel], None]] = None, cancelled: Optional[threading.Event] = None) -> List[BaseModel]:
+    """Attend la fin d'une tâche en interrogeant son état ; `on_question` reçoit chaque nouvelle question reçue.
 
-def generate_questions(text_source: str, difficulty: str, num_questions: int, type_question: str, temperature: float) -> List[BaseModel]:
-    if not LLM_CLIENT:
+    Si `cancelled` est levé pendant l'attente, la demande est retirée de la tâche (annulée s'il n'en reste aucune) et [] est retourné.
+    """
+    job = GENERATION_JOBS.get(job_id)
+    if job is None:
         return []
-    
-    target_model, schema_description, example_output = get_target_config(type_question)
-    target_schema = target_model.model_json_schema()
+    shown = 0
+    while True:
+        if cancelled is not None and cancelled.is_set():
+            GENERATION_JOBS.unsubscribe(job_id)
+            return []
+        finished = job.done.wait(GENERATION_JOB_POLL_S)
+        if on_question is not None:
+            for question in job.questions[shown:]:
+                on_question(question)
+            shown = len(job.questions)
+        if finished:
+            return job.result or []
 
-    example_output_str = json.dumps(example_output, indent=2)
-    
-    difficulty_instruction = get_difficulty_instructions(difficulty)
+#Pré-génération spéculative de l'examen suivant
 
-    system_prompt = f"""
-    Vous êtes un assistant pédagogique expert générant des questions de type {type_question} ({schema_description}) basées sur le texte fourni.
-    Le niveau de difficulté doit être strictement : {difficulty}. {difficulty_instruction}
-    
-    INSTRUCTION CRITIQUE: Votre sortie DOIT être STRICTEMENT un tableau JSON (JSON array) contenant exactement {num_questions} objets, SANS AUCUN AUTRE TEXTE NI MARKDOWN avant ou après.
-    
-    EXEMPLE DE STRUCTURE ATTENDUE (N'UTILISEZ PAS CE CONTENU, SEULEMENT LE FORMAT):
-    {example_output_str}
-    
-    SCHEMA JSON (POUR RÉFÉRENCE) :
-    {json.dumps(target_schema, indent=2)}
-    """
-    
-    MAX_RETRIES = 3
-    #Retry pour tolérer les erreurs de formatage JSON du LLM.
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = LLM_CLIENT.chat.completions.create(
-                model=LLM_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Générer {num_questions} questions basées sur le texte suivant : \n\n{text_source}"}
-                ],
-                response_format={"type": "json_object"}, 
-                temperature=temperature 
-            )
-            
-            json_string = response.choices[0].message.content.strip()
-            
-            questions = extract_and_validate_json(json_string, target_model)
-            
-            if len(questions) < num_questions:
-                 st.warning(f"Attention : Le modèle a généré seulement {len(questions)} questions valides au lieu de {num_questions} demandées.")
+# Examens pré-générés simultanément pour tout le processus ; au-delà, la pré-génération est simplement ignorée.
+# Les générations elles-mêmes passent par la file commune et comptent dans GENERATION_MAX_CONCURRENT_JOBS.
+PREFETCH_MAX_IN_FLIGHT = 2
 
-            return questions
+@dataclass
+class PrefetchSlot:
+    """Examen suivant en préparation pour une session : paramètres de génération, tâche et signal d'annulation."""
+    params: tuple
+    future: Future
+    cancelled: threading.Event
 
-        except Exception as e:
-            if attempt < MAX_RETRIES - 1:
-                wait_time = 2 ** attempt
-                st.warning(f"Erreur LLM/Pydantic (Tentative n°{attempt+1} échouée : {e}). Nouvelle tentative dans {wait_time}s...")
-                time.sleep(wait_time)
-            else:
-                st.error(f"Échec après {MAX_RETRIES} tentatives pour cause d'erreur LLM : {e}")
-                st.error("Échec critique de la génération JSON structurée. Simplifiez le texte source, augmentez la température, ou vérifiez la clé API.")
-                return []
-    return []
+@st.cache_resource(show_spinner=False)
+def init_prefetch_pool():
+    """Pool de threads et sémaphore partagés par toutes les sessions, pour borner les requêtes spéculatives."""
+    executor = ThreadPoolExecutor(max_workers=PREFETCH_MAX_IN_FLIGHT, thread_name_prefix="akalearn-prefetch")
+    return executor, threading.BoundedSemaphore(PREFETCH_MAX_IN_FLIGHT)
+
+PREFETCH_EXECUTOR, PREFETCH_SLOTS = init_prefetch_pool()
+
+def prefetch_params(exam_params: tuple) -> tuple:
+    """Paramètres de l'examen suivant : ceux de l'examen courant, sans cache ni banque (sinon l'examen courant serait resservi)."""
+    return exam_params[:-1] + (False,)
+
+def _prefetch_exam(params: tuple, cancelled: threading.Event) -> List[BaseModel]:
+    try:
+        if cancelled.is_set():
+            return []
+        # Passe par la file commune : une demande identique d'une autre session partage la même génération.
+        return wait_for_generation_job(submit_generation_job(params), cancelled=cancelled)
+    finally:
+        PREFETCH_SLOTS.release()
+
+def schedule_prefetch(params: tuple) -> Optional[PrefetchSlot]:
+    """Lance en arrière-plan la génération d'un examen avec `params` ; None si trop de pré-générations sont déjà en cours."""
+    if not PREFETCH_SLOTS.acquire(blocking=False):
+        return None
+    cancelled = threading.Event()
+    try:
+        future = submit_with_context(PREFETCH_EXECUTOR, _prefetch_exam, params, cancelled)
+    except RuntimeError:
+        PREFETCH_SLOTS.release()
+        return None
+    return PrefetchSlot(params, future, cancelled)
+
+def cancel_prefetch(slot: PrefetchSlot) -> None:
+    """Abandonne une pré-génération : la tâche partagée est annulée si aucune autre demande ne l'attend.
+
+    Une tâche en attente ne démarre pas ; une tâche en cours n'envoie plus de lot ni de complément
+    (la requête déjà partie se termine, et son emplacement de pré-génération est libéré sans l'attendre).
+    """
+    slot.cancelled.set()
+    if slot.future.cancel():
+        PREFETCH_SLOTS.release()
+
+def take_prefetched_exam(slot: PrefetchSlot) -> List[BaseModel]:
+    """Questions de l'examen pré-généré (attend la fin si la génération est encore en cours) ; [] en cas d'échec."""
+    try:
+        return slot.future.result()
+    except Exception:
+        return []
 
 #Correction par LLM
 
-def get_llm_feedback(question_text: str, user_answer: str, expected_keywords: List[str]) -> CorrectionFeedback:
-    """Demande au LLM de corriger une question ouverte et de donner un feedback structuré."""
-    # Fonction dédiée à la correction des questions ouvertes
-    if not LLM_CLIENT:
-        return CorrectionFeedback(score_percentage=0, feedback_text="Erreur de configuration LLM.", is_correct=False)
-    
-    target_schema = CorrectionFeedback.model_json_schema()
-    
-    system_prompt = f"""
-    Vous êtes un correcteur pédagogique expert. Votre tâche est d'évaluer la justesse d'une réponse utilisateur à une question ouverte.
-    
-    Question : {question_text}
-    Mots-clés attendus (pour référence) : {', '.join(expected_keywords)}
-    Réponse de l'utilisateur : {user_answer}
-    
-    INSTRUCTION CRITIQUE: Votre sortie DOIT être STRICTEMENT un OBJET JSON, SANS AUCUN AUTRE TEXTE NI MARKDOWN avant ou après.
-    Évaluez la réponse et attribuez un score en pourcentage (0-100). Définissez 'is_correct' à True si le score est >= 70.
-    
-    SCHEMA JSON (POUR SORTIE) :
-    {json.dumps(target_schema, indent=2)}
+# Nombre maximal de corrections envoyées en parallèle et délai maximal (secondes) par requête Groq.
+GRADING_MAX_WORKERS = 8
+GRADING_TIMEOUT_S = 20.0
+
+def get_llm_feedback(question_text: str, user_answer: str, expected_keywords: List[str], timeout: Optional[float] = None, notify: bool = True) -> Optional[CorrectionFeedback]:
+    """Demande au LLM de corriger une question ouverte et de donner un feedback structuré.
+
+    Retourne None si la correction n'a pas abouti (configuration, délai, disjoncteur ouvert, quota, format invalide) :
+    un échec n'est pas une note, la réponse reste à corriger.
+    `notify=False` désactive les messages Streamlit (appel depuis un thread de correction).
     """
+    # Fonction dédiée à la correction des questions ouvertes
+    if not LLM_PROVIDERS:
+        return None
+
+    # Une réponse identique (après normalisation) déjà corrigée n'est pas renvoyée au LLM.
+    cache_key = grading_cache_key(question_text, user_answer, expected_keywords)
+    cached_feedback = get_cached_feedback(cache_key)
+    if cached_feedback is not None:
+        return cached_feedback
     
     MAX_RETRIES = 2
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = LLM_CLIENT.chat.completions.create(
-                model=LLM_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                ],
-                response_format={"type": "json_object"},
-                temperature=0.2
-            )
-            
-            json_string = response.choices[0].message.content.strip()
-            
-            # Validation correction
-            feedback_list = extract_and_validate_json(json_string, CorrectionFeedback)
-            
-            return feedback_list[0] if feedback_list else CorrectionFeedback(score_percentage=0, feedback_text="LLM n'a pas pu structurer le feedback (erreur interne ou format invalide).", is_correct=False)
+    try:
+        feedback_list = call_llm(
+            messages=build_grading_messages(question_text, user_answer, expected_keywords),
+            temperature=0.2,
+            max_retries=MAX_RETRIES,
+            timeout=timeout,
+            response_model=CorrectionFeedback,
+            call_site="correction",
+            response_format={"type": "json_object"}
+        )
+    except Exception as e:
+        if notify:
+            st.error(f"Échec de la correction LLM : {e}")
+        return None
 
-        except Exception as e:
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(1) 
+    if not feedback_list:
+        return None
+
+    # Seules les corrections réellement produites par le LLM sont mises en cache.
+    store_cached_feedback(cache_key, feedback_list[0])
+    return feedback_list[0]
+
+def grade_open_answers_batch(pending: List[dict], on_feedback: Callable[[int, CorrectionFeedback], None]) -> None:
+    """Corrige en parallèle les réponses ouvertes en attente et transmet chaque correction à `on_feedback` au fil de l'eau.
+
+    Chaque élément de `pending` contient 'index', 'question', 'answer' et 'keywords'.
+    Les requêtes partent toutes en même temps (pool borné), le temps total est donc proche d'un seul aller-retour.
+    Les corrections échouées ne sont pas transmises : les réponses restent à corriger et seront relancées à la prochaine vérification.
+    """
+    if not pending:
+        return
+
+    progress = st.progress(0.0, text=f"Correction de {len(pending)} question(s) ouverte(s) par Llama 3 (via Groq)...")
+    # Délai global : toutes les tentatives d'une requête, l'attente maximale du limiteur, plus une marge.
+    overall_timeout = GRADING_TIMEOUT_S * 2 + LLM_MAX_WAIT_S + 5
+
+    executor = ThreadPoolExecutor(max_workers=min(GRADING_MAX_WORKERS, len(pending)))
+    futures = {
+        submit_with_context(
+            executor,
+            get_llm_feedback,
+            question_text=item['question'],
+            user_answer=item['answer'],
+            expected_keywords=item['keywords'],
+            timeout=GRADING_TIMEOUT_S,
+            notify=False
+        ): item['index']
+        for item in pending
+    }
+
+    done = 0
+    failed = 0
+    try:
+        for future in as_completed(futures, timeout=overall_timeout):
+            feedback = future.result()
+            if feedback is None:
+                failed += 1
             else:
-                st.error(f"Échec après {MAX_RETRIES} tentatives de correction LLM : {e}")
-                return CorrectionFeedback(score_percentage=0, feedback_text=f"Échec critique de la correction LLM : {e}", is_correct=False)
-    
-    return CorrectionFeedback(score_percentage=0, feedback_text="Échec inconnu de la correction LLM.", is_correct=False)
+                on_feedback(futures[future], feedback)
+            done += 1
+            progress.progress(done / len(pending), text=f"Correction : {done}/{len(pending)} question(s) ouverte(s)")
+    except FuturesTimeoutError:
+        # Les corrections non terminées ne sont pas mises en cache : elles seront relancées au prochain affichage.
+        failed += len(pending) - done
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        progress.empty()
+    if failed:
+        st.error(f"{failed} correction(s) n'ont pas abouti (délai, quota ou service indisponible). Réessayez la vérification.")
+
+#Pré-correction locale des questions ouvertes
+
+# Part des mots-clés retrouvés au-delà de laquelle la réponse est validée sans appel LLM.
+PREGRADE_PASS_COVERAGE = 0.8
+# Similarité minimale (difflib) pour qu'un mot de la réponse compte comme un mot-clé mal orthographié.
+PREGRADE_FUZZY_RATIO = 0.85
+# Longueur minimale des racines comparées approximativement : en dessous, une lettre de plus suffit à dépasser le ratio
+# ("sel" / "seul", "eau" / "beau"), seule la correspondance exacte compte.
+PREGRADE_FUZZY_MIN_LENGTH = 5
+
+FRENCH_STOPWORDS = frozenset(
+    "a au aux avec ce ces cet cette dans de des du elle en est et etre il ils je la le les leur leurs lui ma mais "
+    "me meme mes moi mon ne nos notre nous on ou par pas pour qu que qui sa se ses son sont sur ta te tes toi ton "
+    "tu un une vos votre vous y c d j l m n s t a ete sont fait faire plus tres bien car donc ainsi alors".split()
+)
+# Suffixes retirés par le raccourcisseur (stemmer léger) ; les plus longs sont essayés en premier.
+FRENCH_SUFFIXES = (
+    "issements", "issement", "atrices", "ateurs", "ations", "ements", "ation", "ateur", "atrice",
+    "ement", "ences", "ments", "ence", "euses", "ment", "euse", "ites", "ite", "ives", "eux", "ive",
+    "aux", "ifs", "if", "es", "er", "ez", "s", "e"
+)
+
+@dataclass
+class PregradeResult:
+    """Résultat de la pré-correction : score local, confiance et feedback si la décision est sans ambiguïté."""
+    score_percentage: int
+    confidence: float
+    feedback: Optional[CorrectionFeedback] = None
+
+def strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+def stem_french(word: str) -> str:
+    """Raccourcit un mot français à sa racine approximative (pluriels, féminins, suffixes courants)."""
+    for suffix in FRENCH_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def normalize_for_pregrade(text: str) -> List[str]:
+    """Racines des mots significatifs d'un texte (sans accents, casse ni mots vides)."""
+    words = re.findall(r"\w+", strip_accents(text).casefold())
+    return [stem_french(w) for w in words if w not in FRENCH_STOPWORDS]
+
+def stem_in_answer(stem: str, answer_stems: set) -> bool:
+    if stem in answer_stems:
+        return True
+    if len(stem) < PREGRADE_FUZZY_MIN_LENGTH:
+        return False
+    return any(
+        difflib.SequenceMatcher(None, stem, candidate).ratio() >= PREGRADE_FUZZY_RATIO
+        for candidate in answer_stems if len(candidate) >= PREGRADE_FUZZY_MIN_LENGTH
+    )
+
+def pregrade_open_answer(user_answer: str, expected_keywords: List[str]) -> PregradeResult:
+    """Évalue localement la couverture des mots-clés ; ne fournit un feedback que pour les cas évidents.
+
+    - aucune racine de mot-clé dans la réponse (réponse vide de sens ou hors sujet) : échec certain ;
+    - au moins PREGRADE_PASS_COVERAGE des mots-clés retrouvés : réussite certaine ;
+    - sinon la réponse est ambiguë et doit être corrigée par le LLM (feedback None).
+    """
+    answer_stems = set(normalize_for_pregrade(user_answer))
+    keyword_stems = [normalize_for_pregrade(k) for k in expected_keywords]
+    keyword_stems = [stems for stems in keyword_stems if stems]
+    if not keyword_stems:
+        return PregradeResult(score_percentage=0, confidence=0.0)
+
+    if not answer_stems:
+        return PregradeResult(0, 1.0, CorrectionFeedback(
+            score_percentage=0,
+            feedback_text="Correction automatique : la réponse ne contient aucun élément significatif.",
+            is_correct=False
+        ))
+
+    matched_keywords = []
+    matched_stems = total_stems = 0
+    for keyword, stems in zip(expected_keywords, keyword_stems):
+        found = [stem_in_answer(stem, answer_stems) for stem in stems]
+        matched_stems += sum(found)
+        total_stems += len(found)
+        if all(found):
+            matched_keywords.append(keyword)
+
+    coverage = len(matched_keywords) / len(keyword_stems)
+    stem_overlap = matched_stems / total_stems
+    score = round(coverage * 100)
+
+    if stem_overlap == 0:
+        return PregradeResult(0, 1.0, CorrectionFeedback(
+            score_percentage=0,
+            feedback_text=f"Correction automatique : aucun des éléments attendus n'apparaît dans la réponse ({', '.join(expected_keywords)}).",
+            is_correct=False
+        ))
+    if coverage >= PREGRADE_PASS_COVERAGE:
+        missing = [k for k in expected_keywords if k not in matched_keywords]
+        feedback_text = "Correction automatique : les éléments attendus sont présents."
+        if missing:
+            feedback_text += f" Il manque encore : {', '.join(missing)}."
+        return PregradeResult(score, coverage, CorrectionFeedback(
+            score_percentage=score,
+            feedback_text=feedback_text,
+            is_correct=score >= 70
+        ))
+    # Zone ambiguë : la confiance diminue à mesure que la couverture s'approche du seuil de réussite.
+    return PregradeResult(score, 1.0 - coverage / PREGRADE_PASS_COVERAGE)
+
+#État de l'examen
+
+PLACEHOLDER_RADIO = "Choisir la bonne réponse"
+EMPTY_RESPONSE = "Non répondu"
+# Questions affichées (et corrigées) par page : le coût d'un rerun ne dépend pas de la longueur de l'examen.
+EXAM_PAGE_SIZE = 10
+# Nombre maximal de questions en mode grand examen (10 en mode normal).
+LARGE_EXAM_MAX_QUESTIONS = 200
+
+STATUS_CORRECT = "✅ Correcte"
+STATUS_WRONG = "❌ Fausse"
+STATUS_UNANSWERED = "❓ Non répondu"
+STATUS_UNGRADED = "⏳ À corriger"
+
+def correct_answer_text(question: dict) -> str:
+    """Réponse attendue telle qu'affichée (et comparée pour les QCM et Vrai/Faux)."""
+    if question.get('__type__') == 'VraiFauxQuestion':
+        return "Vrai" if question.get('correct_answer') else "Faux"
+    if question.get('__type__') == 'QuestionOuverte':
+        return f"Mots-clés attendus : {', '.join(question.get('keywords'))}"
+    return question.get('correct_answer')
+
+@dataclass(slots=True)
+class ExamState:
+    """Réponses, corrections et score d'un examen, indexés par position de question.
+
+    Le score, les compteurs et le tableau récapitulatif (`summary`) sont mis à jour à chaque changement de réponse
+    ou de correction, jamais recalculés en entier.
+    `epoch` préfixe les clés des widgets : un nouvel examen repart de widgets vierges sans effacer les anciennes clés une à une.
+    """
+    questions: List[dict]
+    answers: List[Optional[str]]
+    feedback: List[Optional[dict]]
+    correct: List[bool]
+    options: List[Optional[List[str]]]
+    summary: List[dict]
+    score: int = 0
+    answered: int = 0
+    # Réponses ouvertes saisies mais pas encore corrigées.
+    ungraded: int = 0
+    page: int = 0
+    epoch: str = ""
+    # Tentative déjà versée à l'historique (seule la première vérification compte, avant d'avoir vu la correction).
+    recorded: bool = False
+
+    @classmethod
+    def for_questions(cls, questions: List[dict]) -> "ExamState":
+        count = len(questions)
+        # Ordre des options QCM tiré une fois pour toutes, pour rester stable entre les reruns.
+        options = [random.sample(q['options'], len(q['options'])) if q.get('__type__') == 'MCQQuestion' else None for q in questions]
+        summary = [{"Q.": i + 1, "Thème": q.get('topic'), "Statut": STATUS_UNANSWERED} for i, q in enumerate(questions)]
+        return cls(questions, [None] * count, [None] * count, [False] * count, options, summary, epoch=uuid.uuid4().hex[:8])
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-len(self.questions) // EXAM_PAGE_SIZE))
+
+    def page_indices(self) -> range:
+        """Positions des questions de la page affichée."""
+        start = self.page * EXAM_PAGE_SIZE
+        return range(start, min(start + EXAM_PAGE_SIZE, len(self.questions)))
+
+    def widget_key(self, index: int, kind: str) -> str:
+        return f"q_{self.epoch}_{index}_{kind}"
+
+    def is_ungraded(self, index: int) -> bool:
+        return self.questions[index].get('__type__') == 'QuestionOuverte' and self.answers[index] is not None and self.feedback[index] is None
+
+    def _set_correct(self, index: int, is_correct: bool) -> None:
+        self.score += int(is_correct) - int(self.correct[index])
+        self.correct[index] = is_correct
+        if is_correct:
+            status = STATUS_CORRECT
+        elif self.answers[index] is None:
+            status = STATUS_UNANSWERED
+        else:
+            status = STATUS_UNGRADED if self.is_ungraded(index) else STATUS_WRONG
+        self.summary[index]["Statut"] = status
+
+    def set_answer(self, index: int, answer: Optional[str]) -> None:
+        """Enregistre une réponse ; les QCM et Vrai/Faux sont notés immédiatement, les questions ouvertes à la vérification."""
+        if not isinstance(answer, str) or not answer.strip() or answer == PLACEHOLDER_RADIO:
+            answer = None
+        was_ungraded = self.is_ungraded(index)
+        self.answered += int(answer is not None) - int(self.answers[index] is not None)
+        self.answers[index] = answer
+        # La correction d'une ancienne réponse ouverte n'est plus valable.
+        self.feedback[index] = None
+        self.ungraded += int(self.is_ungraded(index)) - int(was_ungraded)
+        question = self.questions[index]
+        self._set_correct(index, answer is not None and question.get('__type__') != 'QuestionOuverte' and answer == correct_answer_text(question))
+
+    def set_feedback(self, index: int, feedback: dict) -> None:
+        self.ungraded -= int(self.is_ungraded(index))
+        self.feedback[index] = feedback
+        self._set_correct(index, bool(feedback['is_correct']))
+
+def get_exam_state() -> Optional[ExamState]:
+    """État de l'examen affiché, recréé lorsque de nouvelles questions remplacent les précédentes."""
+    questions_list = st.session_state.get('questions_data')
+    if not questions_list:
+        return None
+    exam = st.session_state.get('exam')
+    if exam is None or exam.questions is not questions_list:
+        exam = st.session_state['exam'] = ExamState.for_questions(questions_list)
+    return exam
 
 #Affichage test
 
 def reset_all_data(full_reset=False):
     """Nettoie l'état de session lié aux questions, réponses et résultats."""
     st.session_state['show_results'] = False
-    
-    # Supprime toutes les clés de session liées aux réponses et corrections pour repartir à zéro.
-    keys_to_delete = [
-        k for k in list(st.session_state.keys()) 
-        if k.startswith('q_') or k.startswith('feedback_q_') or k.endswith('_radio') or k.endswith('_text')
-    ]
-    for k in keys_to_delete:
-        if k in st.session_state:
-            del st.session_state[k]
-    
+    # Les widgets de l'ancien examen ne sont plus affichés : Streamlit libère leur état au rerun suivant.
+    st.session_state['exam'] = None
+
     if full_reset:
         st.session_state['questions_data'] = None 
         st.success("Examen réinitialisé. Veuillez générer de nouvelles questions.")
 
 def reset_show_results():
-    """Callback pour désactiver l'affichage des résultats et forcer la regénération du feedback."""
-    # Efface les anciens feedbacks pour qu'ils soient recalculés si l'utilisateur change une réponse.
+    """Callback pour désactiver l'affichage des résultats."""
+    # Les corrections restent valables : elles ne sont invalidées que si la réponse correspondante change.
+    st.session_state['show_results'] = False
+
+def update_user_answer(widget_key: str, index: int):
+    """Callback: met à jour la réponse de l'utilisateur (et le score) et désactive l'affichage des résultats."""
+    st.session_state['exam'].set_answer(index, st.session_state.get(widget_key))
     st.session_state['show_results'] = False
-    keys_to_delete = [k for k in list(st.session_state.keys()) if k.startswith('feedback_q_')]
-    for k in keys_to_delete:
-        if k in st.session_state:
-            del st.session_state[k]
-
-def update_user_answer(widget_key: str, q_key: str):
-    """Callback: met à jour la réponse de l'utilisateur et désactive l'affichage des résultats."""
-    st.session_state[q_key] = st.session_state.get(widget_key)
-    reset_show_results()
+    st.session_state['answers_changed'] = True
+
+def render_answer_progress(placeholder, exam: ExamState) -> None:
+    """En-tête léger de l'examen : nombre de questions répondues."""
+    placeholder.caption(f"Réponses données : {exam.answered}/{len(exam.questions)}")
+
+def change_exam_page(delta: int):
+    """Callback : page précédente ou suivante de l'examen."""
+    exam = st.session_state['exam']
+    exam.page = min(max(exam.page + delta, 0), exam.page_count - 1)
+
+def render_page_navigation(exam: ExamState, position: str) -> None:
+    """Boutons de pagination (absents si l'examen tient sur une page)."""
+    if exam.page_count <= 1:
+        return
+    col_previous, col_label, col_next = st.columns([0.2, 0.6, 0.2])
+    with col_previous:
+        st.button("◀ Précédent", key=f"page_previous_{position}", on_click=change_exam_page, args=(-1,), disabled=exam.page == 0)
+    with col_label:
+        indices = exam.page_indices()
+        st.caption(f"Page {exam.page + 1}/{exam.page_count} — questions {indices.start + 1} à {indices.stop}")
+    with col_next:
+        st.button("Suivant ▶", key=f"page_next_{position}", on_click=change_exam_page, args=(1,), disabled=exam.page >= exam.page_count - 1)
+
+@st.fragment
+def question_fragment(index: int, results: Optional[dict], progress_placeholder) -> None:
+    """Question isolée dans un fragment : changer sa réponse ne réexécute que ce bloc, pas toute la page."""
+    # Des résultats affichés deviennent obsolètes dès qu'une réponse change : la page entière est alors relancée.
+    if results is not None and not st.session_state['show_results']:
+        st.rerun()
+    exam = st.session_state['exam']
+    display_question_test(exam, index, results is not None, results)
+    if st.session_state.pop('answers_changed', False):
+        render_answer_progress(progress_placeholder, exam)
     
-def display_question_test(question, index: int, show_results: bool, results: dict = None):
+def display_question_test(exam: ExamState, index: int, show_results: bool, results: dict = None):
     """Affiche une question pour le test et enregistre la réponse de l'utilisateur."""
 
+    question = exam.questions[index]
+    # Les widgets des autres pages ne sont pas rendus (Streamlit libère leur état) : la valeur affichée vient de l'examen.
     q_type = question.get('__type__')
-    qid = question.get('id')
-    q_key = f"q_{qid}_answer"
     q_text = question.get('question')
     q_topic = question.get('topic')
-    
-    PLACEHOLDER_RADIO = "Choisir la bonne réponse"
 
     col_q, col_status = st.columns([0.9, 0.1])
     
@@ -302,7 +2542,7 @@ def display_question_test(question, index: int, show_results: bool, results: dic
     
     if show_results and results:
         status = results.get('is_correct')
-        user_answered = (results.get('user_text') != "Non répondu")
+        user_answered = (results.get('user_text') != EMPTY_RESPONSE)
         
         with col_status:
             if status:
@@ -316,58 +2556,39 @@ def display_question_test(question, index: int, show_results: bool, results: dic
 
     # Logique d'affichage des widgets spécifiques (radio pour QCM/VraiFaux, text_area pour Ouvert)
     if q_type == 'MCQQuestion':
-        options_key = f"q_{qid}_options"
-        if options_key not in st.session_state:
-            opts = question.get('options')[:]
-            random.shuffle(opts)
-            st.session_state[options_key] = opts
-
-        options_mixed = st.session_state[options_key]
-        displayed_options = [PLACEHOLDER_RADIO] + options_mixed
-
-        radio_widget_key = f"q_{qid}_radio"
-        st.session_state.setdefault(radio_widget_key, st.session_state.get(q_key, PLACEHOLDER_RADIO))
-        if st.session_state[radio_widget_key] not in displayed_options:
-            st.session_state[radio_widget_key] = PLACEHOLDER_RADIO
-        
+        radio_widget_key = exam.widget_key(index, "radio")
+        options = [PLACEHOLDER_RADIO] + exam.options[index]
         st.radio(
             label="Choisissez une option :",
-            options=displayed_options,
+            options=options,
+            index=options.index(exam.answers[index]) if exam.answers[index] in options else 0,
             key=radio_widget_key,
             on_change=update_user_answer,
-            args=(radio_widget_key, q_key)
+            args=(radio_widget_key, index)
         )
 
     elif q_type == 'VraiFauxQuestion':
         # Logique similaire au QCM, mais avec seulement Vrai/Faux.
-        options = ["Vrai", "Faux"]
-        displayed_options = [PLACEHOLDER_RADIO] + options
-
-        radio_widget_key = f"q_{qid}_radio"
-        st.session_state.setdefault(radio_widget_key, st.session_state.get(q_key, PLACEHOLDER_RADIO))
-
-        if st.session_state[radio_widget_key] not in displayed_options:
-            st.session_state[radio_widget_key] = PLACEHOLDER_RADIO
-            
+        radio_widget_key = exam.widget_key(index, "radio")
+        options = [PLACEHOLDER_RADIO, "Vrai", "Faux"]
         st.radio(
             label="Est-ce une affirmation Vraie ou Fausse :",
-            options=displayed_options,
+            options=options,
+            index=options.index(exam.answers[index]) if exam.answers[index] in options else 0,
             key=radio_widget_key,
             on_change=update_user_answer,
-            args=(radio_widget_key, q_key)
+            args=(radio_widget_key, index)
         )
 
     elif q_type == 'QuestionOuverte':
         # Widget text_area pour la réponse libre.
-        text_widget_key = f"q_{qid}_text"
-        st.session_state.setdefault(text_widget_key, st.session_state.get(q_key, ""))
-
+        text_widget_key = exam.widget_key(index, "text")
         st.text_area(
             label="Votre réponse :",
+            value=exam.answers[index] or "",
             key=text_widget_key,
-            value=st.session_state.get(text_widget_key, ""), 
             on_change=update_user_answer,
-            args=(text_widget_key, q_key)
+            args=(text_widget_key, index)
         )
 
 #Logique correction
@@ -376,97 +2597,358 @@ def check_results():
     """Déclenche l'affichage des résultats."""
     st.session_state['show_results'] = True
 
-def calculate_score(questions_list):
-    """Calcule le score et retourne les détails de la correction."""
-    score = 0
-    total = len(questions_list)
-    results = []
-    
-    PLACEHOLDER_RADIO = "Choisir la bonne réponse"
-    EMPTY_RESPONSE = "Non répondu"
-
-    # Vérifie si une correction LLM est nécessaire pour les questions ouvertes.
-    is_open_question_correction_needed = any(
-        q.get('__type__') == 'QuestionOuverte' and f"feedback_q_{q.get('id')}" not in st.session_state
-        for q in questions_list
-    )
-    
-    if is_open_question_correction_needed:
-        st.info("Correction des questions ouvertes en cours par Llama 3 (via Groq)...")
-        with st.empty():
-            pass
-
-    for i, question in enumerate(questions_list):
-        qid = question.get('id')
-        q_key = f"q_{qid}_answer"
-        user_choice = st.session_state.get(q_key)
-        is_correct = False
-        user_text = EMPTY_RESPONSE
-        llm_feedback = None 
-
-        if user_choice is None or user_choice == PLACEHOLDER_RADIO or (isinstance(user_choice, str) and not user_choice.strip()):
-            user_choice = None
-        
-        correct_text = ""
-
-        # Logique de correction pour les questions QCM, Vrai/Faux
-        if question.get('__type__') == 'MCQQuestion':
-            correct_text = question.get('correct_answer')
-            if user_choice:
-                user_text = user_choice
-                is_correct = (user_choice == correct_text)
-            
-        elif question.get('__type__') == 'VraiFauxQuestion':
-            correct_answer_val = question.get('correct_answer')
-            correct_answer_str = "Vrai" if correct_answer_val else "Faux"
-            correct_text = correct_answer_str
-            if user_choice:
-                user_text = user_choice
-                is_correct = (user_choice == correct_text)
-            
-        # Logique de correction pour les questions ouvertes (avec appel au LLM si nécessaire)
-        elif question.get('__type__') == 'QuestionOuverte':
-            keywords = question.get('keywords')
-            correct_text = f"Mots-clés attendus : {', '.join(keywords)}"
-            
-            if user_choice and user_choice.strip():
-                user_text = user_choice
-                
-                feedback_key = f"feedback_q_{qid}"
-                
-                # Correction LLM (uniquement si les résultats sont affichés ET que le feedback n'a pas encore été calculé)
-                if feedback_key not in st.session_state and st.session_state['show_results']:
-                    feedback_obj = get_llm_feedback(
-                        question_text=question.get('question'),
-                        user_answer=user_choice,
-                        expected_keywords=keywords
-                    )
-                    llm_feedback = feedback_obj.model_dump()
-                    st.session_state[feedback_key] = llm_feedback
-                
-                llm_feedback = st.session_state.get(feedback_key)
+def grade_pending_answers(exam: ExamState, indices: Optional[range] = None) -> None:
+    """Corrige les réponses ouvertes sans correction (parmi `indices`, par défaut toutes) : localement si possible, sinon en une seule passe parallèle."""
+    pending = []
+    for i in indices if indices is not None else range(len(exam.questions)):
+        if not exam.is_ungraded(i):
+            continue
+        question = exam.questions[i]
+        answer = exam.answers[i]
+        # Les cas évidents (hors sujet, mots-clés tous présents) sont corrigés localement, sans appel LLM.
+        pregrade = pregrade_open_answer(answer, question.get('keywords'))
+        if pregrade.feedback is not None:
+            exam.set_feedback(i, pregrade.feedback.model_dump())
+            continue
+        pending.append({
+            'index': i,
+            'question': question.get('question'),
+            'answer': answer,
+            'keywords': question.get('keywords')
+        })
+    grade_open_answers_batch(pending, lambda i, feedback: exam.set_feedback(i, feedback.model_dump()))
 
-                if llm_feedback:
-                    is_correct = llm_feedback['is_correct']
-            
-        if is_correct:
-            score += 1
-        
+def exam_results(exam: ExamState, indices: Optional[range] = None) -> List[dict]:
+    """Détail de la correction des questions `indices` (par défaut toutes), à partir de l'état déjà noté."""
+    results = []
+    for i in indices if indices is not None else range(len(exam.questions)):
+        question = exam.questions[i]
+        answer = exam.answers[i]
         results.append({
             'index': i + 1, 
             'question': question.get('question'),
             'topic': question.get('topic'),
-            'user_text': user_text,
-            'correct_text': correct_text,
-            'is_correct': is_correct,
-            'llm_feedback': llm_feedback 
+            'user_text': answer if answer is not None else EMPTY_RESPONSE,
+            'correct_text': correct_answer_text(question),
+            'is_correct': exam.correct[i],
+            # Feedback rempli par la pré-correction ou le LLM (absent si la correction a échoué : la réponse reste à corriger).
+            'llm_feedback': exam.feedback[i],
+            'ungraded': exam.is_ungraded(i)
+        })
+    return results
+
+
+#Historique des résultats et statistiques de cohorte
+
+# Base SQLite des tentatives (distincte du cache, qui peut être supprimé sans perte d'historique).
+RESULTS_DB_PATH = ENV.get("AKALEARN_RESULTS_DB", ".akalearn_results.sqlite3")
+# Les tentatives sont écrites par lots, depuis un thread dédié : au plus RESULTS_BATCH_SIZE par transaction, au plus tard après RESULTS_FLUSH_INTERVAL_S.
+RESULTS_BATCH_SIZE = 100
+RESULTS_FLUSH_INTERVAL_S = 2.0
+# Part des points au-delà de laquelle un examen est réussi.
+EXAM_PASS_RATE = 0.5
+# Réponses minimales sur un thème pour qu'il apparaisse parmi les thèmes faibles.
+WEAK_TOPIC_MIN_ANSWERS = 5
+# Largeur (en points de pourcentage) des classes de la distribution des scores de correction.
+GRADING_SCORE_BUCKET = 10
+
+RESULTS_SCHEMA = (
+    # Données brutes, une ligne par tentative et par réponse, pour les analyses ponctuelles.
+    "CREATE TABLE IF NOT EXISTS attempts ("
+    "attempt_id TEXT PRIMARY KEY, session_id TEXT, created_at REAL NOT NULL, exam_key TEXT NOT NULL, "
+    "difficulty TEXT NOT NULL, type_question TEXT NOT NULL, score INTEGER NOT NULL, total INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS attempts_exam ON attempts (exam_key, created_at)",
+    "CREATE TABLE IF NOT EXISTS attempt_answers ("
+    "attempt_id TEXT NOT NULL, question_index INTEGER NOT NULL, topic_key TEXT NOT NULL, difficulty TEXT NOT NULL, "
+    "answered INTEGER NOT NULL, is_correct INTEGER NOT NULL, grading_score INTEGER, PRIMARY KEY (attempt_id, question_index))",
+    "CREATE INDEX IF NOT EXISTS attempt_answers_topic ON attempt_answers (topic_key, difficulty)",
+    # Agrégats tenus à jour à chaque écriture : les statistiques se lisent sans reparcourir les données brutes.
+    "CREATE TABLE IF NOT EXISTS topic_stats ("
+    "topic_key TEXT NOT NULL, difficulty TEXT NOT NULL, label TEXT NOT NULL, answers INTEGER NOT NULL, "
+    "answered INTEGER NOT NULL, correct INTEGER NOT NULL, PRIMARY KEY (topic_key, difficulty))",
+    "CREATE TABLE IF NOT EXISTS exam_stats ("
+    "exam_key TEXT NOT NULL, difficulty TEXT NOT NULL, type_question TEXT NOT NULL, label TEXT NOT NULL, "
+    "attempts INTEGER NOT NULL, passed INTEGER NOT NULL, score_sum INTEGER NOT NULL, total_sum INTEGER NOT NULL, "
+    "last_attempt REAL NOT NULL, PRIMARY KEY (exam_key, difficulty, type_question))",
+    "CREATE TABLE IF NOT EXISTS grading_score_stats ("
+    "difficulty TEXT NOT NULL, bucket INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (difficulty, bucket))"
+)
+
+class ResultsStore:
+    """Historique des tentatives : file d'écriture vidée par lots dans SQLite par un thread démon."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ready = self._init_db()
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True, name="akalearn-results-writer").start()
+        # Les tentatives encore en file sont écrites avant l'arrêt du processus.
+        atexit.register(self.flush)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    def _init_db(self) -> bool:
+        try:
+            with closing(self._connect()) as conn, conn:
+                # WAL : les lectures des statistiques ne bloquent pas l'écriture des lots.
+                conn.execute("PRAGMA journal_mode=WAL")
+                for statement in RESULTS_SCHEMA:
+                    conn.execute(statement)
+            return True
+        except sqlite3.Error:
+            return False
+
+    def submit(self, attempt: dict) -> None:
+        """Met une tentative en file ; ne bloque jamais le rerun Streamlit."""
+        if self.ready:
+            self._queue.put(attempt)
+
+    def flush(self) -> None:
+        """Attend que toutes les tentatives en file soient écrites."""
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + RESULTS_FLUSH_INTERVAL_S
+            while len(batch) < RESULTS_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except sqlite3.Error as e:
+                telemetry_logger.warning(f"{len(batch)} tentative(s) non enregistrée(s) : {e}")
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, batch: List[dict]) -> None:
+        """Écrit un lot en une transaction ; les agrégats sont d'abord cumulés en mémoire puis ajoutés par UPSERT."""
+        topics = {}
+        exams = {}
+        grading_scores = Counter()
+        answer_rows = []
+        for attempt in batch:
+            difficulty = attempt['difficulty']
+            exam = exams.setdefault(
+                (attempt['exam_key'], difficulty, attempt['type_question']),
+                {'label': attempt['label'], 'attempts': 0, 'passed': 0, 'score_sum': 0, 'total_sum': 0, 'last_attempt': 0.0}
+            )
+            exam['attempts'] += 1
+            exam['passed'] += int(attempt['total'] > 0 and attempt['score'] >= EXAM_PASS_RATE * attempt['total'])
+            exam['score_sum'] += attempt['score']
+            exam['total_sum'] += attempt['total']
+            exam['last_attempt'] = max(exam['last_attempt'], attempt['created_at'])
+            for answer in attempt['answers']:
+                topic = topics.setdefault((answer['topic_key'], difficulty), {'label': answer['topic'], 'answers': 0, 'answered': 0, 'correct': 0})
+                topic['answers'] += 1
+                topic['answered'] += int(answer['answered'])
+                topic['correct'] += int(answer['is_correct'])
+                if answer['grading_score'] is not None:
+                    grading_scores[(difficulty, min(answer['grading_score'] // GRADING_SCORE_BUCKET, 100 // GRADING_SCORE_BUCKET - 1))] += 1
+                answer_rows.append((
+                    attempt['attempt_id'], answer['index'], answer['topic_key'], difficulty,
+                    int(answer['answered']), int(answer['is_correct']), answer['grading_score']
+                ))
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO attempts (attempt_id, session_id, created_at, exam_key, difficulty, type_question, score, total) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(a['attempt_id'], a['session_id'], a['created_at'], a['exam_key'], a['difficulty'], a['type_question'], a['score'], a['total']) for a in batch]
+            )
+            conn.executemany("INSERT OR IGNORE INTO attempt_answers VALUES (?, ?, ?, ?, ?, ?, ?)", answer_rows)
+            conn.executemany(
+                "INSERT INTO topic_stats (topic_key, difficulty, label, answers, answered, correct) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (topic_key, difficulty) DO UPDATE SET answers = answers + excluded.answers, "
+                "answered = answered + excluded.answered, correct = correct + excluded.correct",
+                [(key, difficulty, t['label'], t['answers'], t['answered'], t['correct']) for (key, difficulty), t in topics.items()]
+            )
+            conn.executemany(
+                "INSERT INTO exam_stats (exam_key, difficulty, type_question, label, attempts, passed, score_sum, total_sum, last_attempt) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (exam_key, difficulty, type_question) DO UPDATE SET "
+                "attempts = attempts + excluded.attempts, passed = passed + excluded.passed, score_sum = score_sum + excluded.score_sum, "
+                "total_sum = total_sum + excluded.total_sum, last_attempt = MAX(last_attempt, excluded.last_attempt)",
+                [(key, difficulty, type_question, e['label'], e['attempts'], e['passed'], e['score_sum'], e['total_sum'], e['last_attempt'])
+                 for (key, difficulty, type_question), e in exams.items()]
+            )
+            conn.executemany(
+                "INSERT INTO grading_score_stats (difficulty, bucket, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (difficulty, bucket) DO UPDATE SET count = count + excluded.count",
+                [(difficulty, bucket, count) for (difficulty, bucket), count in grading_scores.items()]
+            )
+
+    def query(self, sql: str, params: tuple = ()) -> List[dict]:
+        """Lecture des statistiques ; [] si la base est indisponible."""
+        try:
+            with closing(self._connect()) as conn:
+                conn.row_factory = sqlite3.Row
+                return [dict(row) for row in conn.execute(sql, params)]
+        except sqlite3.Error:
+            return []
+
+@st.cache_resource(show_spinner=False)
+def init_results_store() -> ResultsStore:
+    """Historique unique par processus, partagé par toutes les sessions."""
+    return ResultsStore(RESULTS_DB_PATH)
+
+RESULTS_STORE = init_results_store()
+
+def build_attempt_record(exam: ExamState, meta: Optional[dict], session_id: Optional[str]) -> dict:
+    """Tentative corrigée, prête à être écrite : score, puis thème, statut et score de correction de chaque réponse."""
+    meta = meta or {}
+    answers = []
+    for i, question in enumerate(exam.questions):
+        topic = question.get('topic') or ""
+        feedback = exam.feedback[i]
+        answers.append({
+            'index': i,
+            # Les thèmes sont regroupés sans tenir compte de la casse ni des espaces.
+            'topic_key': normalize_grading_text(topic),
+            'topic': topic,
+            'answered': exam.answers[i] is not None,
+            'is_correct': exam.correct[i],
+            'grading_score': feedback['score_percentage'] if feedback else None
         })
+    return {
+        'attempt_id': f"{exam.epoch}-{uuid.uuid4().hex[:8]}",
+        'session_id': session_id,
+        'created_at': time.time(),
+        'exam_key': meta.get('exam_key') or exam.epoch,
+        'label': meta.get('label') or (exam.questions[0].get('topic') if exam.questions else ""),
+        'difficulty': meta.get('difficulty', "Inconnue"),
+        'type_question': meta.get('type_question', "Inconnu"),
+        'score': exam.score,
+        'total': len(exam.questions),
+        'answers': answers
+    }
+
+def weak_topics(difficulty: Optional[str] = None, limit: int = 20) -> List[dict]:
+    """Thèmes les moins bien réussis (au moins WEAK_TOPIC_MIN_ANSWERS réponses), toutes difficultés ou une seule."""
+    return RESULTS_STORE.query(
+        "SELECT MIN(label) AS topic, SUM(answers) AS answers, SUM(answered) AS answered, "
+        "ROUND(100.0 * SUM(correct) / SUM(answers), 1) AS success_rate "
+        "FROM topic_stats WHERE (? IS NULL OR difficulty = ?) GROUP BY topic_key "
+        "HAVING SUM(answers) >= ? ORDER BY success_rate ASC, answers DESC LIMIT ?",
+        (difficulty, difficulty, WEAK_TOPIC_MIN_ANSWERS, limit)
+    )
+
+def pass_rates_by_difficulty() -> List[dict]:
+    """Tentatives, taux de réussite (score >= EXAM_PASS_RATE) et score moyen par difficulté."""
+    return RESULTS_STORE.query(
+        "SELECT difficulty, SUM(attempts) AS attempts, ROUND(100.0 * SUM(passed) / SUM(attempts), 1) AS pass_rate, "
+        "ROUND(100.0 * SUM(score_sum) / SUM(total_sum), 1) AS mean_score "
+        "FROM exam_stats GROUP BY difficulty ORDER BY difficulty"
+    )
+
+def grading_score_distribution(difficulty: Optional[str] = None) -> List[dict]:
+    """Répartition des scores de correction des questions ouvertes, par classes de GRADING_SCORE_BUCKET points."""
+    return RESULTS_STORE.query(
+        "SELECT bucket * ? AS score_from, SUM(count) AS count FROM grading_score_stats "
+        "WHERE (? IS NULL OR difficulty = ?) GROUP BY bucket ORDER BY bucket",
+        (GRADING_SCORE_BUCKET, difficulty, difficulty)
+    )
+
+def exam_report(exam_key: Optional[str] = None, limit: int = 50) -> List[dict]:
+    """Statistiques par examen (texte source, difficulté, type), les plus récemment passés d'abord."""
+    return RESULTS_STORE.query(
+        "SELECT exam_key, label, difficulty, type_question, attempts, ROUND(100.0 * passed / attempts, 1) AS pass_rate, "
+        "ROUND(100.0 * score_sum / total_sum, 1) AS mean_score, last_attempt FROM exam_stats "
+        "WHERE (? IS NULL OR exam_key = ?) ORDER BY last_attempt DESC LIMIT ?",
+        (exam_key, exam_key, limit)
+    )
+
+def render_analytics_page() -> None:
+    """Page de statistiques de la cohorte, lue uniquement dans les tables d'agrégats."""
+    st.header("Statistiques")
+    difficulty_rates = pass_rates_by_difficulty()
+    if not difficulty_rates:
+        st.info("Aucune tentative enregistrée pour l'instant : les résultats le sont à la première vérification de chaque examen.")
+        return
+
+    st.markdown("#### Réussite par difficulté")
+    st.dataframe(
+        [{"Difficulté": r['difficulty'], "Tentatives": r['attempts'], "Réussite (%)": r['pass_rate'], "Score moyen (%)": r['mean_score']} for r in difficulty_rates],
+        use_container_width=True, hide_index=True
+    )
+
+    difficulty = st.selectbox("Difficulté :", options=["Toutes"] + [r['difficulty'] for r in difficulty_rates], key="analytics_difficulty")
+    difficulty = None if difficulty == "Toutes" else difficulty
+
+    st.markdown("#### Thèmes les moins maîtrisés")
+    topics = weak_topics(difficulty)
+    if topics:
+        st.dataframe(
+            [{"Thème": t['topic'], "Réponses": t['answers'], "Répondues": t['answered'], "Réussite (%)": t['success_rate']} for t in topics],
+            use_container_width=True, hide_index=True
+        )
+    else:
+        st.caption(f"Pas encore de thème avec au moins {WEAK_TOPIC_MIN_ANSWERS} réponses.")
 
-    return score, total, results
+    distribution = grading_score_distribution(difficulty)
+    if distribution:
+        st.markdown("#### Scores de correction des questions ouvertes")
+        chart = []
+        for d in distribution:
+            # La dernière classe inclut 100 %.
+            score_to = 100 if d['score_from'] + GRADING_SCORE_BUCKET >= 100 else d['score_from'] + GRADING_SCORE_BUCKET - 1
+            chart.append({"Score": f"{d['score_from']}-{score_to}%", "Réponses": d['count']})
+        st.bar_chart(chart, x="Score", y="Réponses")
 
+    st.markdown("#### Examens")
+    st.dataframe(
+        [{
+            "Examen": e['label'], "Difficulté": e['difficulty'], "Type": e['type_question'], "Tentatives": e['attempts'],
+            "Réussite (%)": e['pass_rate'], "Score moyen (%)": e['mean_score'],
+            "Dernière tentative": time.strftime("%Y-%m-%d %H:%M", time.localtime(e['last_attempt']))
+        } for e in exam_report()],
+        use_container_width=True, hide_index=True
+    )
 
 #Streamlit
 
+def question_to_dict(q: BaseModel) -> dict:
+    """Convertit une question validée en dictionnaire d'état de session (avec id et type)."""
+    try:
+        qd = q.model_dump()
+    except Exception:
+        qd = q.__dict__
+    # Génération id pour chaque question
+    qid = hashlib.sha1((qd.get('question','') + qd.get('topic','')).encode()).hexdigest()[:8]
+    qd['id'] = qid
+    qd['__type__'] = type(q).__name__
+    return qd
+
+def load_uploaded_documents(uploaded_files) -> List[Tuple[DocumentInfo, str]]:
+    """Importe les fichiers déposés, une seule fois chacun ; la session ne garde que leurs métadonnées, jamais leur texte."""
+    # file_id -> DocumentInfo, ou message d'erreur pour ne pas réessayer un fichier illisible à chaque rerun.
+    known = st.session_state.setdefault('documents', {})
+    loaded = []
+    for uploaded in uploaded_files or []:
+        info = known.get(uploaded.file_id)
+        if isinstance(info, str):
+            st.error(info)
+            continue
+        # Texte relu depuis le cache partagé ; réextrait seulement s'il en a été évincé.
+        text = get_document_text(info.file_hash) if info is not None else None
+        if text is None:
+            try:
+                with st.spinner(f"Extraction du texte de {uploaded.name}"):
+                    info, text = ingest_document(uploaded, uploaded.name)
+            except DocumentError as e:
+                known[uploaded.file_id] = str(e)
+                st.error(str(e))
+                continue
+            known[uploaded.file_id] = info
+        loaded.append((info, text))
+    # Fichiers retirés du dépôt : leurs métadonnées sont oubliées.
+    current_ids = {uploaded.file_id for uploaded in uploaded_files or []}
+    for file_id in set(known) - current_ids:
+        del known[file_id]
+    return loaded
+
 def main():
     st.set_page_config(page_title="Générateur d'exams LLM", layout="wide")
     st.title("AKAlearn Quiz")
@@ -478,8 +2960,17 @@ def main():
     if 'show_results' not in st.session_state:
          st.session_state['show_results'] = False 
 
+    # Les appels LLM de ce rerun (y compris depuis les threads) sont rattachés à la session.
+    if 'telemetry_session_id' not in st.session_state:
+         st.session_state['telemetry_session_id'] = uuid.uuid4().hex
+    TELEMETRY.session.set(st.session_state['telemetry_session_id'])
+
+    # Zone d'aperçu des questions reçues en streaming pendant la génération.
+    stream_placeholder = st.empty()
 
     with st.sidebar:
+        # Les paramètres restent affichés sur les deux pages pour ne pas perdre le texte saisi.
+        view = st.radio("Page :", options=["Examen", "Statistiques"], horizontal=True)
         st.header("Paramètres de l'exam")
         
         text_source = st.text_area(
@@ -487,80 +2978,153 @@ def main():
             value="",
             height=200
         )
+        uploaded_files = st.file_uploader(
+            "Ou importez des documents :",
+            type=list(DOCUMENT_TYPES),
+            accept_multiple_files=True,
+            max_upload_size=DOCUMENT_MAX_MB,
+            help=f"PDF, DOCX, Markdown ou texte, {DOCUMENT_MAX_MB} Mo au plus par fichier. Le texte extrait est mis en cache : réimporter le même fichier est immédiat."
+        )
+        documents = load_uploaded_documents(uploaded_files)
+        for info, _ in documents:
+            st.caption(f"📄 {info.name} : {info.chars:,} caractères".replace(",", " ") + (f" (tronqué à {DOCUMENT_MAX_CHARS:,} caractères)".replace(",", " ") if info.truncated else ""))
+        if documents:
+            # Texte collé et documents importés forment ensemble le texte source ; un document seul est utilisé tel quel, sans copie.
+            parts = [part for part in [text_source.strip()] + [text for _, text in documents] if part]
+            text_source = parts[0] if len(parts) == 1 else "\n\n".join(parts)
         
         difficulty = st.selectbox("Difficulté :", options=["Facile", "Moyen", "Difficile", "Expert"])
         type_question = st.selectbox("Type de Question :", options=["QCM", "Vrai/Faux", "Ouvert"])
-        num_questions = st.slider("Nombre de questions :", min_value=1, max_value=10, value=5)
+        large_exam = st.checkbox(
+            "Mode grand examen",
+            value=False,
+            help=f"Examens d'entraînement jusqu'à {LARGE_EXAM_MAX_QUESTIONS} questions : génération par lots parallèles, affichage et correction page par page ({EXAM_PAGE_SIZE} questions par page)."
+        )
+        if large_exam:
+            num_questions = st.slider("Nombre de questions :", min_value=10, max_value=LARGE_EXAM_MAX_QUESTIONS, value=50, step=5)
+        else:
+            num_questions = st.slider("Nombre de questions :", min_value=1, max_value=10, value=5)
         temperature = st.slider(
             "Créativité / Température LLM (0.0=Factuel, 1.0=Créatif)", 
             min_value=0.0, max_value=1.0, value=0.7, step=0.05
         )
         st.session_state['temperature'] = temperature
+        use_cache = st.checkbox(
+            "Réutiliser les examens en cache",
+            value=True,
+            help="Réutilise les examens et la banque de questions déjà générés pour ce texte. Décochez pour forcer de nouvelles questions (utile avec une température élevée)."
+        )
+        use_streaming = st.checkbox(
+            "Affichage progressif des questions",
+            value=True,
+            help="Affiche chaque question dès qu'elle est générée (streaming)."
+        )
+        use_prefetch = st.checkbox(
+            "Pré-générer l'examen suivant",
+            value=False,
+            help="Pendant que vous répondez, un nouvel examen (hors cache et banque de questions) est préparé en arrière-plan avec les mêmes paramètres : le prochain clic sur « Générer l'exam » est immédiat. Consomme des appels LLM même si l'examen n'est jamais demandé."
+        )
+
+        # Un examen pré-généré avec d'autres paramètres ne servira plus : il est abandonné.
+        exam_params = (text_source, difficulty, num_questions, type_question, temperature, use_cache)
+        prefetch_slot = st.session_state.get('prefetch_slot')
+        if prefetch_slot is not None and (not use_prefetch or prefetch_slot.params != prefetch_params(exam_params)):
+            cancel_prefetch(prefetch_slot)
+            prefetch_slot = st.session_state['prefetch_slot'] = None
 
         st.markdown("---")
         
+        # Questions obtenues pendant ce rerun (None : aucune génération demandée ni en cours).
+        questions = None
         if st.button("Générer l'exam", type="primary"):
             if not text_source.strip():
                 st.error("Veuillez fournir un texte source.")
-            elif not LLM_CLIENT:
-                 st.error("Erreur de Configuration. Veuillez vérifier votre clé API Groq (GROQ_API_KEY).")
+            elif not LLM_PROVIDERS:
+                 st.error("Erreur de Configuration. Veuillez vérifier votre clé API Groq (GROQ_API_KEY) ou l'adresse du modèle local (AKALEARN_LOCAL_LLM_URL).")
             else:
                 reset_all_data(full_reset=False)
-                
-                with st.spinner(f"Génération des questions de type {type_question} en cours"):
-                    questions = generate_questions(text_source, difficulty, num_questions, type_question, temperature)
-                    
-                    if questions:
-                        questions_dicts = []
-                        for q in questions:
-                            try:
-                                qd = q.model_dump()
-                            except Exception:
-                                qd = q.__dict__
-                            # Génération id pour chaque question
-                            qid = hashlib.sha1((qd.get('question','') + qd.get('topic','')).encode()).hexdigest()[:8]
-                            qd['id'] = qid
-                            qd['__type__'] = type(q).__name__
-                            questions_dicts.append(qd)
-                        st.session_state['questions_data'] = questions_dicts
-                        st.success(f"{len(questions)} questions de type '{type_question}' générées avec succès!")
-                    else:
-                        st.session_state['questions_data'] = None
+                questions = []
+                if prefetch_slot is not None:
+                    st.session_state['prefetch_slot'] = None
+                    with st.spinner("Récupération de l'examen pré-généré"):
+                        questions = take_prefetched_exam(prefetch_slot)
+                if not questions:
+                    # File commune : une demande identique déjà en cours dans une autre session partage sa génération.
+                    st.session_state['generation_job'] = submit_generation_job(exam_params, stream=use_streaming)
+                    questions = None
+
+        # Suivi de la tâche lancée par ce clic, ou reprise après un rerun qui a interrompu l'attente.
+        job_id = st.session_state.get('generation_job')
+        if job_id is not None:
+            on_question = None
+            if use_streaming:
+                # Chaque question validée est affichée dès que la tâche la reçoit.
+                stream_preview = stream_placeholder.container()
+                streamed = []
+
+                def on_question(q):
+                    streamed.append(q)
+                    with stream_preview:
+                        st.markdown(f"#### Q{len(streamed)}. {q.question}")
+                        st.caption(f"Type: {type(q).__name__} | Thème: {q.topic}")
+
+            with st.spinner(f"Génération des questions de type {type_question} en cours"):
+                questions = wait_for_generation_job(job_id, on_question)
+                stream_placeholder.empty()
+            st.session_state['generation_job'] = None
+
+        if questions is not None:
+            if questions:
+                st.session_state['questions_data'] = [question_to_dict(q) for q in questions]
+                # Identité de l'examen pour l'historique des résultats (le texte lui-même n'est pas conservé).
+                st.session_state['exam_meta'] = {
+                    'exam_key': source_fingerprint(text_source),
+                    'label': (documents[0][0].name if documents else text_source.strip().split("\n", 1)[0])[:80],
+                    'difficulty': difficulty,
+                    'type_question': type_question
+                }
+                st.success(f"{len(questions)} questions de type '{type_question}' générées avec succès!")
+                if len(questions) < num_questions:
+                    st.warning(f"Attention : Le modèle a généré seulement {len(questions)} questions valides au lieu de {num_questions} demandées.")
+                if use_prefetch:
+                    st.session_state['prefetch_slot'] = schedule_prefetch(prefetch_params(exam_params))
+            else:
+                st.session_state['questions_data'] = None
+                st.error("Échec de la génération : aucune question valide. Simplifiez le texte source, augmentez la température, ou vérifiez la configuration du LLM.")
 
     #Affichage exam
-    if st.session_state['questions_data']:
+    exam = get_exam_state()
+    if view == "Statistiques":
+        render_analytics_page()
+    elif exam is not None:
         st.header("Quizz")
-        questions_list = st.session_state['questions_data']
         
-        # Prépare l'état des résultats avant l'affichage.
+        # Correction et détail des résultats calculés une seule fois par rerun, pour la page affichée seulement ; le score est déjà à jour.
         results_snapshot_list = []
         results_snapshot = {}
-        score = 0
-        total = len(questions_list)
+        total = len(exam.questions)
+        page_indices = exam.page_indices()
         
         if st.session_state['show_results']:
-             score, total, results_snapshot_list = calculate_score(questions_list)
+             grade_pending_answers(exam, page_indices)
+             results_snapshot_list = exam_results(exam, page_indices)
              results_snapshot = {r['index']: r for r in results_snapshot_list}
+             # Tentative versée à l'historique (écriture en arrière-plan) dès que toutes les réponses sont corrigées :
+             # une correction échouée laisse sa réponse à corriger et retarde l'enregistrement.
+             if not exam.recorded and exam.ungraded == 0:
+                 RESULTS_STORE.submit(build_attempt_record(exam, st.session_state.get('exam_meta'), st.session_state['telemetry_session_id']))
+                 exam.recorded = True
+        score = exam.score
         
-        # Initialisation stable des réponses dans st.session_state
-        PLACEHOLDER_RADIO = "Choisir la bonne réponse"
-        for i, question in enumerate(questions_list):
-             qid = question.get('id')
-             q_key = f"q_{qid}_answer"
-             is_open = (question.get('__type__') == 'QuestionOuverte')
-             if q_key not in st.session_state:
-                 st.session_state[q_key] = "" if is_open else PLACEHOLDER_RADIO
-        
-        
-        for i, question in enumerate(questions_list):
-            q_index = i + 1
-            display_question_test(
-                question, 
-                i, 
-                st.session_state['show_results'], 
-                results_snapshot.get(q_index)
-            )
+        progress_placeholder = st.empty()
+        render_answer_progress(progress_placeholder, exam)
+        render_page_navigation(exam, "top")
 
+        # Une question par fragment : répondre ne relance pas le rendu des autres questions ni le calcul du score.
+        for i in page_indices:
+            question_fragment(i, results_snapshot.get(i + 1), progress_placeholder)
+
+        render_page_navigation(exam, "bottom")
         st.markdown("---")
         
         col_buttons_1, col_buttons_2, _ = st.columns([0.3, 0.3, 0.4])
@@ -574,31 +3138,21 @@ def main():
         #Affiche resultats
         if st.session_state['show_results']:
             
-            if not results_snapshot:
-                 score, total, results_snapshot_list = calculate_score(questions_list)
-            
             st.header("Les resultaats")
             final_percentage = round((score/total)*100) if total > 0 else 0
             
             # Score
             st.success(f"### Score Final : {score}/{total} ({final_percentage}%)")
+            if exam.ungraded:
+                st.info(f"{exam.ungraded} réponse(s) ouverte(s) pas encore corrigée(s) : elles le seront à la prochaine vérification ou à l'affichage de leur page.")
             st.markdown("---")
             
-            #Tableau résumé reponses
-            summary_data = []
-            for result in results_snapshot_list:
-                status_emoji = "✅ Correcte" if result['is_correct'] else ("❌ Fausse" if result['user_text'] != "Non répondu" else "❓ Non répondu")
-                summary_data.append({
-                    "Q.": result['index'],
-                    "Thème": result['topic'],
-                    "Statut": status_emoji
-                })
-
+            #Tableau résumé reponses (tenu à jour par l'état de l'examen, jamais reconstruit)
             st.markdown("#### Résultats")
-            st.dataframe(summary_data, use_container_width=True, hide_index=True)
+            st.dataframe(exam.summary, use_container_width=True, hide_index=True)
             st.markdown("---")
 
-            st.markdown("#### Correction")
+            st.markdown("#### Correction" if exam.page_count == 1 else f"#### Correction (page {exam.page + 1}/{exam.page_count})")
             
             # Affichage correction
             for result in results_snapshot_list:
@@ -620,13 +3174,24 @@ def main():
                 with col2:
                     if result['is_correct']:
                         st.success("Correcte")
-                    elif result['user_text'] != "Non répondu":
+                    elif result['ungraded']:
+                        st.info("À corriger")
+                    elif result['user_text'] != EMPTY_RESPONSE:
                         st.error("Fausse")
                     else:
                         st.warning("Non Répondu")
                         
                 st.markdown("---")
 
+    # Résumé des appels LLM de la session (tokens, latence, retries), affiché après les appels de ce rerun.
+    if st.sidebar.checkbox("Afficher la télémétrie LLM", value=False):
+        summary = TELEMETRY.session_summary(st.session_state['telemetry_session_id'])
+        with st.sidebar.expander("Télémétrie de la session", expanded=True):
+            if summary:
+                st.dataframe(summary, use_container_width=True, hide_index=True)
+            else:
+                st.caption("Aucun appel LLM dans cette session.")
+
     # Debug: Bouton pour réinitialiser complètement l'application 
     if st.sidebar.button("Réinitialisation session", key='full_reset_btn'):
         reset_all_data(full_reset=True)
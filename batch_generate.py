@@ -0,0 +1,225 @@
+"""Génération d'examens en lot, sans interface, à partir d'un dossier de documents ou d'un fichier JSONL.
+
+Exemples :
+    python batch_generate.py cours/ -o examens.jsonl --workers 4
+    python batch_generate.py sources.jsonl -o examens/ --format parquet --type Ouvert --num-questions 8
+
+Chaque ligne d'un fichier JSONL source contient au minimum "text", et optionnellement "id",
+"difficulty", "type_question", "num_questions" et "temperature" (sinon les valeurs de la ligne de commande).
+Les documents terminés sont notés dans un fichier de checkpoint : relancer la même commande reprend là où elle s'est arrêtée.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List, Optional
+
+import streamlit.logger
+
+# Hors de `streamlit run`, les appels st.* de app2 ne font rien : on coupe leurs avertissements.
+streamlit.logger.set_log_level("error")
+
+import app2
+
+SOURCE_EXTENSIONS = tuple("." + extension for extension in app2.DOCUMENT_TYPES)
+
+def iter_sources(path: str) -> Iterator[dict]:
+    """Parcourt les documents sources d'un dossier (fichiers .pdf/.docx/.md/.txt) ou d'un fichier JSONL."""
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if name.lower().endswith(SOURCE_EXTENSIONS):
+                    file_path = os.path.join(root, name)
+                    # Texte extrait au fil des pages et mis en cache par empreinte : une reprise ne réextrait rien.
+                    try:
+                        info, text = app2.ingest_document_file(file_path)
+                    except app2.DocumentError as e:
+                        print(f"Document ignoré : {e}", file=sys.stderr)
+                        continue
+                    if info.truncated:
+                        print(f"{name} tronqué à {app2.DOCUMENT_MAX_CHARS} caractères.", file=sys.stderr)
+                    yield {"id": os.path.relpath(file_path, path), "text": text}
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                source = json.loads(line)
+                source.setdefault("id", f"ligne-{line_number}")
+                yield source
+
+def load_checkpoint(checkpoint_path: str) -> set:
+    """Identifiants des documents déjà traités lors d'une exécution précédente."""
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+class JsonlWriter:
+    """Ajoute les questions validées à un fichier JSONL, une ligne par question."""
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, rows: List[dict]) -> None:
+        for row in rows:
+            self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+class ParquetWriter:
+    """Écrit les questions dans un fichier Parquet par exécution (un dossier de fichiers se relit avec pyarrow.dataset)."""
+
+    COLUMNS = ("source_id", "question_index", "type_question", "difficulty", "topic", "question", "payload")
+
+    def __init__(self, directory: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("Le format parquet nécessite pyarrow : pip install pyarrow")
+        os.makedirs(directory, exist_ok=True)
+        self._pa = pa
+        self._schema = pa.schema([(c, pa.int32() if c == "question_index" else pa.string()) for c in self.COLUMNS])
+        path = os.path.join(directory, f"part-{time.strftime('%Y%m%d-%H%M%S')}.parquet")
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, rows: List[dict]) -> None:
+        if not rows:
+            return
+        columns = {c: [] for c in self.COLUMNS}
+        for row in rows:
+            for c in self.COLUMNS[:-1]:
+                columns[c].append(row[c])
+            columns["payload"].append(json.dumps(row["payload"], ensure_ascii=False))
+        self._writer.write_table(self._pa.table(columns, schema=self._schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+def generate_for_source(source: dict, args: argparse.Namespace) -> List[dict]:
+    """Génère l'examen d'un document et le met en forme pour l'écriture."""
+    difficulty = source.get("difficulty", args.difficulty)
+    type_question = source.get("type_question", args.type)
+    questions = app2.generate_questions(
+        source["text"],
+        difficulty,
+        int(source.get("num_questions", args.num_questions)),
+        type_question,
+        float(source.get("temperature", args.temperature)),
+        use_cache=not args.no_cache
+    )
+    rows = []
+    for index, question in enumerate(questions):
+        payload = question.model_dump()
+        rows.append({
+            "source_id": source["id"],
+            "question_index": index,
+            "type_question": type_question,
+            "difficulty": difficulty,
+            "topic": payload.get("topic", ""),
+            "question": payload.get("question", ""),
+            "payload": payload
+        })
+    return rows
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Génération d'examens en lot à partir d'un corpus de textes.")
+    parser.add_argument("sources", help="Dossier de documents (.pdf, .docx, .md, .txt) ou fichier JSONL de sources.")
+    parser.add_argument("-o", "--output", required=True, help="Fichier JSONL de sortie, ou dossier pour --format parquet.")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--checkpoint", help="Fichier de reprise (par défaut : <output>.checkpoint).")
+    parser.add_argument("--difficulty", default="Moyen", choices=["Facile", "Moyen", "Difficile", "Expert"])
+    parser.add_argument("--type", default="QCM", choices=["QCM", "Vrai/Faux", "Ouvert"])
+    parser.add_argument("--num-questions", type=int, default=5)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--workers", type=int, default=4, help="Nombre de documents traités en parallèle.")
+    parser.add_argument("--requests-per-minute", type=float, default=app2.LLM_REQUESTS_PER_MINUTE, help="Quota Groq (sans effet sur un modèle local).")
+    parser.add_argument("--tokens-per-minute", type=float, default=app2.LLM_TOKENS_PER_MINUTE, help="Quota Groq (sans effet sur un modèle local).")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore le cache local des examens.")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if not app2.LLM_PROVIDERS:
+        print(app2.LLM_INIT_ERROR, file=sys.stderr)
+        return 1
+
+    # Limiteurs dédiés au lot (fournisseurs à quota seulement) ; les attentes longues sont acceptées au lieu d'échouer comme dans l'interface.
+    for provider in app2.LLM_PROVIDERS:
+        if provider.request_limiter is not None:
+            provider.request_limiter = app2.TokenBucket(args.requests_per_minute)
+            provider.token_limiter = app2.TokenBucket(args.tokens_per_minute)
+    app2.LLM_MAX_WAIT_S = 300.0
+
+    token_count = [0]
+    token_lock = threading.Lock()
+
+    def count_tokens(usage):
+        with token_lock:
+            token_count[0] += usage.total_tokens
+
+    app2.LLM_USAGE_OBSERVERS.append(count_tokens)
+
+    checkpoint_path = args.checkpoint or args.output.rstrip("/\\") + ".checkpoint"
+    done_ids = load_checkpoint(checkpoint_path)
+    # Sources lues au fil de l'eau : un document n'est extrait (et gardé en mémoire) que lorsqu'un worker va le traiter.
+    sources = (s for s in iter_sources(args.sources) if s["id"] not in done_ids)
+    if done_ids:
+        print(f"Reprise : {len(done_ids)} document(s) déjà traité(s) ignoré(s).", file=sys.stderr)
+
+    writer = ParquetWriter(args.output) if args.format == "parquet" else JsonlWriter(args.output)
+    write_lock = threading.Lock()
+    start = time.monotonic()
+    completed = failed = question_count = 0
+
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # Au plus `workers` documents en cours : les suivants ne sont lus qu'à mesure que des places se libèrent.
+        futures = {}
+        exhausted = False
+        while futures or not exhausted:
+            while not exhausted and len(futures) < args.workers:
+                source = next(sources, None)
+                if source is None:
+                    exhausted = True
+                else:
+                    futures[executor.submit(generate_for_source, source, args)] = source["id"]
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                source_id = futures.pop(future)
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    rows = []
+                    print(f"Échec pour {source_id} : {e}", file=sys.stderr)
+                if not rows:
+                    # Non noté dans le checkpoint : le document sera retenté à la prochaine exécution.
+                    failed += 1
+                    continue
+                with write_lock:
+                    writer.write(rows)
+                    checkpoint.write(source_id + "\n")
+                    checkpoint.flush()
+                completed += 1
+                question_count += len(rows)
+                elapsed = time.monotonic() - start
+                print(f"[{completed + failed}] {source_id} : {len(rows)} question(s) ({completed / elapsed * 60:.1f} docs/min)", file=sys.stderr)
+
+    writer.close()
+    elapsed = max(time.monotonic() - start, 1e-9)
+    print(
+        f"Terminé : {completed} document(s), {question_count} question(s), {failed} échec(s) en {elapsed:.1f}s — "
+        f"{completed / elapsed * 60:.1f} docs/min, {token_count[0] / elapsed:.0f} tokens/s.",
+        file=sys.stderr
+    )
+    return 0 if failed == 0 else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
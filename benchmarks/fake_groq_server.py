@@ -0,0 +1,178 @@
+"""Serveur local imitant l'endpoint chat-completions de Groq, pour mesurer app2.py sans réseau ni clé API.
+
+Latence, taux d'erreurs 5xx, taux de JSON malformé et taux de réponses 429 sont configurables.
+Utilisation autonome :
+    python benchmarks/fake_groq_server.py --port 8765 --latency 0.4 --malformed-rate 0.1
+puis lancer l'application avec GROQ_BASE_URL=http://127.0.0.1:8765 et une GROQ_API_KEY quelconque.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUESTION_COUNT_PATTERN = re.compile(r"Générer (\d+)")
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+def build_question(type_label: str, index: int, salt: str) -> dict:
+    question = f"Question {index} ({salt}) : quel est le rôle de l'élément {index} décrit dans le texte ?"
+    topic = f"Notion {index}"
+    if "VRAI/FAUX" in type_label:
+        return {"question": question, "correct_answer": index % 2 == 0, "topic": topic}
+    if "OUVERTE" in type_label:
+        return {"question": question, "keywords": ["énergie", "lumière", f"élément {index}"], "topic": topic}
+    return {"question": question, "options": ["Option A", "Option B", "Option C", "Option D"], "correct_answer": "Option B", "topic": topic}
+
+class FakeGroqServer:
+    """Serveur HTTP en thread, compatible avec le SDK Groq (POST /openai/v1/chat/completions, streaming SSE inclus)."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.3, jitter: float = 0.1,
+                 failure_rate: float = 0.0, malformed_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: float = 1.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.stats = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "errors": 0, "rate_limited": 0, "malformed": 0}
+
+    def start(self) -> "FakeGroqServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _draw(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def _count(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += amount
+
+    def build_content(self, messages: list) -> str:
+        """Réponse plausible selon le prompt : correction d'une question ouverte ou tableau de questions."""
+        system = messages[0]["content"] if messages else ""
+        user = messages[1]["content"] if len(messages) > 1 else ""
+        if "correcteur" in system:
+            score = self._random.randint(0, 100)
+            return json.dumps({"score_percentage": score, "feedback_text": "Réponse partiellement correcte.", "is_correct": score >= 70})
+        match = QUESTION_COUNT_PATTERN.search(user) or QUESTION_COUNT_PATTERN.search(system)
+        count = int(match.group(1)) if match else 5
+        salt = f"{self._random.getrandbits(32):08x}"
+        content = json.dumps({"questions": [build_question(system, i, salt) for i in range(count)]}, ensure_ascii=False)
+        if self._draw() < self.malformed_rate:
+            self._count("malformed")
+            # Casse un objet au milieu : le reste doit rester récupérable.
+            content = content.replace('"topic": "Notion 1"', '"topic": Notion 1', 1) if count > 1 else content[:-5]
+        return content
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status: int, payload: dict, headers: dict = None) -> None:
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._send_json(200, server.stats)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                server._count("calls")
+                time.sleep(max(0.0, server.latency + server._random.uniform(-server.jitter, server.jitter)))
+
+                if server._draw() < server.rate_limit_rate:
+                    server._count("rate_limited")
+                    self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                                    {"retry-after": str(server.retry_after)})
+                    return
+                if server._draw() < server.failure_rate:
+                    server._count("errors")
+                    self._send_json(503, {"error": {"message": "Service unavailable", "type": "internal_server_error"}})
+                    return
+
+                messages = body.get("messages", [])
+                content = server.build_content(messages)
+                prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in messages)
+                completion_tokens = estimate_tokens(content)
+                server._count("prompt_tokens", prompt_tokens)
+                server._count("completion_tokens", completion_tokens)
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+                if body.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    for i in range(0, len(content), 24):
+                        chunk = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model"),
+                                 "choices": [{"index": 0, "delta": {"content": content[i:i + 24]}, "finish_reason": None}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.close_connection = True
+                    return
+
+                self._send_json(200, {
+                    "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": usage
+                })
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Faux serveur Groq local pour les benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = FakeGroqServer(args.host, args.port, args.latency, args.jitter, args.failure_rate,
+                            args.malformed_rate, args.rate_limit_rate, seed=args.seed)
+    print(f"Faux serveur Groq sur {server.base_url} (Ctrl+C pour arrêter)")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Compare les versions de prompts (v1 verbeux, v2 compact) : taux de questions valides et tokens d'entrée par appel.
+
+À lancer avant de changer PROMPT_VERSION / GRADING_PROMPT_VERSION dans app2.py :
+    python benchmarks/prompt_regression.py --calls 10              # API Groq réelle (GROQ_API_KEY)
+    python benchmarks/prompt_regression.py --fake --calls 5        # faux serveur local, vérifie seulement la mécanique
+Code de sortie 1 si le taux de validation de la version candidate baisse de plus de --tolerance par rapport à la référence.
+"""
+import argparse
+import os
+import sys
+from typing import List
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SOURCE_TEXT = (
+    "La photosynthèse est le processus par lequel les plantes convertissent l'énergie lumineuse en énergie chimique. "
+    "Elle se déroule dans les chloroplastes, grâce à la chlorophylle, et produit du glucose et de l'oxygène. "
+    "La respiration cellulaire libère ensuite l'énergie stockée dans le glucose sous forme d'ATP."
+)
+GRADING_CASE = ("Quel est le rôle de la chlorophylle ?", "Elle capte la lumière pour la photosynthèse.", ["lumière", "photosynthèse", "pigment"])
+
+def evaluate_generation(app, version: str, type_question: str, calls: int, num_questions: int) -> dict:
+    """Appels de génération avec une version de prompt : questions valides / demandées et tokens du prompt."""
+    target_model = app.get_target_config(type_question)[0]
+    messages = [
+        {"role": "system", "content": app.build_generation_prompt("Moyen", num_questions, type_question, version=version)},
+        {"role": "user", "content": app.build_generation_user_message(SOURCE_TEXT, num_questions)}
+    ]
+    valid = 0
+    for _ in range(calls):
+        try:
+            questions = app.call_llm(messages, 0.7, max_retries=1, response_model=target_model,
+                                     call_site=f"regression_{version}", response_format={"type": "json_object"})
+            valid += min(len(questions), num_questions)
+        except Exception:
+            pass
+    return {
+        "version": version, "cas": f"génération {type_question}",
+        "taux_validation": valid / (calls * num_questions),
+        "tokens_prompt": sum(app.count_tokens(m["content"]) for m in messages)
+    }
+
+def evaluate_grading(app, version: str, calls: int) -> dict:
+    messages = app.build_grading_messages(*GRADING_CASE, version=version)
+    valid = 0
+    for _ in range(calls):
+        try:
+            app.call_llm(messages, 0.0, max_retries=1, response_model=app.CorrectionFeedback,
+                         call_site=f"regression_{version}", response_format={"type": "json_object"})
+            valid += 1
+        except Exception:
+            pass
+    return {
+        "version": version, "cas": "correction",
+        "taux_validation": valid / calls,
+        "tokens_prompt": sum(app.count_tokens(m["content"]) for m in messages)
+    }
+
+def compare(results: List[dict], baseline: str, candidate: str, tolerance: float) -> List[str]:
+    """Cas où la version candidate valide moins bien que la référence (au-delà de la tolérance)."""
+    rates = {(r["version"], r["cas"]): r["taux_validation"] for r in results}
+    return [
+        f"{case} : {rates[(baseline, case)]:.0%} -> {rates[(candidate, case)]:.0%}"
+        for (version, case) in rates
+        if version == candidate and rates[(candidate, case)] < rates[(baseline, case)] - tolerance
+    ]
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Régression des prompts : validation et tokens par version.")
+    parser.add_argument("--baseline", default="v1")
+    parser.add_argument("--candidate", default="v2")
+    parser.add_argument("--calls", type=int, default=10, help="Appels par version et par cas.")
+    parser.add_argument("--num-questions", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Baisse tolérée du taux de validation (0.05 = 5 points).")
+    parser.add_argument("--fake", action="store_true", help="Utilise le faux serveur Groq local au lieu de l'API.")
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.fake:
+        from fake_groq_server import FakeGroqServer
+        server = FakeGroqServer(latency=0.05, jitter=0.0).start()
+        os.environ.update({"GROQ_API_KEY": "regression", "GROQ_BASE_URL": server.base_url})
+
+    import streamlit.logger
+    streamlit.logger.set_log_level("error")
+    import app2
+
+    if not app2.LLM_PROVIDERS:
+        print(app2.LLM_INIT_ERROR, file=sys.stderr)
+        return 1
+    app2.LLM_MAX_WAIT_S = 120.0
+
+    results = []
+    for version in (args.baseline, args.candidate):
+        for type_question in ("QCM", "Vrai/Faux", "Ouvert"):
+            results.append(evaluate_generation(app2, version, type_question, args.calls, args.num_questions))
+        results.append(evaluate_grading(app2, version, args.calls))
+    if server is not None:
+        server.stop()
+
+    print(f"{'Version':8} {'Cas':24} {'validation':>10} {'tokens prompt':>14}")
+    for r in results:
+        print(f"{r['version']:8} {r['cas']:24} {r['taux_validation']:>10.0%} {r['tokens_prompt']:>14}")
+    regressions = compare(results, args.baseline, args.candidate, args.tolerance)
+    for line in regressions:
+        print(f"RÉGRESSION {line}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""Benchmarks reproductibles de app2.py contre le faux serveur Groq local.
+
+Scénarios : extraction JSON seule, generate_questions, correction des questions ouvertes (grade_pending_answers)
+et rerun complet de l'application via streamlit.testing.AppTest. Pour chacun : latence p50/p95,
+appels LLM et tokens par examen.
+
+    python benchmarks/run_benchmarks.py --iterations 20 --latency 0.3 --malformed-rate 0.1
+    python benchmarks/run_benchmarks.py --json resultats.json --baseline reference.json --max-regression 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT_DIR, "app2.py")
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_groq_server import FakeGroqServer, build_question
+
+SOURCE_TEXT = (
+    "La photosynthèse est le processus par lequel les plantes convertissent l'énergie lumineuse en énergie chimique. "
+    "Elle se déroule dans les chloroplastes, grâce à la chlorophylle, et produit du glucose et de l'oxygène. "
+) * 20
+
+def percentile(samples: List[float], p: float) -> float:
+    """Percentile par rang le plus proche (samples non vide)."""
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+def measure(name: str, iterations: int, run_once: Callable[[int], None], server: FakeGroqServer) -> dict:
+    """Exécute `run_once` et agrège latences et consommation LLM (relevée sur le faux serveur)."""
+    server.reset_stats()
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        run_once(i)
+        latencies.append(time.perf_counter() - start)
+    stats = dict(server.stats)
+    return {
+        "scenario": name,
+        "iterations": iterations,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "mean_s": sum(latencies) / iterations,
+        "llm_calls_per_exam": stats["calls"] / iterations,
+        "tokens_per_exam": (stats["prompt_tokens"] + stats["completion_tokens"]) / iterations,
+        "server_errors": stats["errors"] + stats["rate_limited"],
+        "malformed_responses": stats["malformed"]
+    }
+
+def malformed_outputs(count: int) -> List[str]:
+    """Sorties LLM synthétiques, valides et malformées, pour le scénario d'extraction."""
+    outputs = []
+    for i in range(count):
+        content = json.dumps({"questions": [build_question("QCM", j, str(i)) for j in range(10)]}, ensure_ascii=False)
+        if i % 3 == 1:
+            content = content.replace('"topic": "Notion 4"', '"topic": Notion 4', 1)
+        elif i % 3 == 2:
+            content = "Voici les questions demandées :\n" + content + "\nBonne révision ! [fin]"
+        outputs.append(content)
+    return outputs
+
+def open_exam_app(app, num_questions: int):
+    """Prépare une session AppTest avec un examen ouvert déjà généré et des réponses saisies."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    questions = [app.QuestionOuverte(**build_question("OUVERTE", i, "bench")) for i in range(num_questions)]
+    at.session_state["questions_data"] = [app.question_to_dict(q) for q in questions]
+    at.session_state["show_results"] = False
+    at.run()
+    return at
+
+def run(args: argparse.Namespace) -> List[dict]:
+    server = FakeGroqServer(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                            malformed_rate=args.malformed_rate, rate_limit_rate=args.rate_limit_rate, seed=args.seed).start()
+    cache_dir = tempfile.mkdtemp(prefix="akalearn-bench-")
+    os.environ.update({
+        "GROQ_API_KEY": "benchmark",
+        "GROQ_BASE_URL": server.base_url,
+        "AKALEARN_CACHE_DB": os.path.join(cache_dir, "cache.sqlite3"),
+        "AKALEARN_RESULTS_DB": os.path.join(cache_dir, "results.sqlite3"),
+        "GROQ_REQUESTS_PER_MINUTE": "100000",
+        "GROQ_TOKENS_PER_MINUTE": "100000000"
+    })
+
+    import streamlit.logger
+    streamlit.logger.set_log_level("error")
+    import app2
+
+    results = []
+    outputs = malformed_outputs(300)
+    results.append(measure(
+        "extract_and_validate_json", len(outputs),
+        lambda i: app2.extract_with_report(outputs[i], app2.MCQQuestion), server
+    ))
+    results.append(measure(
+        "generate_questions", args.iterations,
+        lambda i: app2.generate_questions(f"{SOURCE_TEXT} Itération {i}.", "Moyen", args.num_questions, "QCM", 0.7, use_cache=False),
+        server
+    ))
+
+    def grade_once(i):
+        at = open_exam_app(app2, args.num_questions)
+        for widget in at.text_area:
+            if widget.key and widget.key.endswith("_text"):
+                # Réponses ambiguës (partiellement couvertes) pour forcer la correction par le LLM.
+                widget.set_value(f"Il s'agit de l'énergie, essai {i}")
+        at.run()
+        at.session_state["show_results"] = True
+        start = time.perf_counter()
+        at.run()
+        grade_once.elapsed.append(time.perf_counter() - start)
+
+    grade_once.elapsed = []
+    grading = measure("grade_pending_answers (correction)", args.iterations, grade_once, server)
+    # Seule la relance qui corrige est chronométrée, pas la préparation de la session.
+    grading.update(p50_s=percentile(grade_once.elapsed, 50), p95_s=percentile(grade_once.elapsed, 95),
+                   mean_s=sum(grade_once.elapsed) / len(grade_once.elapsed))
+    results.append(grading)
+
+    at = open_exam_app(app2, args.num_questions)
+    results.append(measure("rerun Streamlit (AppTest)", args.iterations, lambda i: at.run(), server))
+
+    server.stop()
+    return results
+
+def print_report(results: List[dict]) -> None:
+    header = f"{'Scénario':32} {'n':>4} {'p50 (ms)':>10} {'p95 (ms)':>10} {'appels/exam':>12} {'tokens/exam':>12}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:32} {r['iterations']:>4} {r['p50_s'] * 1000:>10.2f} {r['p95_s'] * 1000:>10.2f} "
+              f"{r['llm_calls_per_exam']:>12.2f} {r['tokens_per_exam']:>12.0f}")
+
+def find_regressions(results: List[dict], baseline: List[dict], max_regression: float) -> List[str]:
+    """Scénarios dont le p95, les appels ou les tokens par examen dépassent la référence de plus de `max_regression`."""
+    reference = {r["scenario"]: r for r in baseline}
+    regressions = []
+    for r in results:
+        ref = reference.get(r["scenario"])
+        if ref is None:
+            continue
+        for metric in ("p95_s", "llm_calls_per_exam", "tokens_per_exam"):
+            if ref[metric] > 0 and r[metric] > ref[metric] * (1 + max_regression):
+                regressions.append(f"{r['scenario']} : {metric} {ref[metric]:.3f} -> {r[metric]:.3f}")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks de app2.py avec un faux serveur Groq.")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--num-questions", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.3, help="Latence moyenne du faux serveur (s).")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Écrit les résultats dans ce fichier JSON.")
+    parser.add_argument("--baseline", help="Fichier JSON de référence (issu de --json) pour détecter les régressions.")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Dégradation relative tolérée (0.2 = +20 %%).")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.max_regression)
+        for line in regressions:
+            print(f"RÉGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+"""Pré-correction locale des questions ouvertes : les mots-clés courts ne sont jamais rapprochés approximativement."""
+import os
+import sys
+
+import pytest
+import streamlit.logger
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+streamlit.logger.set_log_level("error")
+
+import app2
+
+@pytest.mark.parametrize("answer, keywords", [
+    ("Le seul genre est beau.", ["sel", "gène", "eau"]),
+    ("Il est loin.", ["loi"]),
+])
+def test_short_keywords_are_not_fuzzy_matched(answer, keywords):
+    result = app2.pregrade_open_answer(answer, keywords)
+    assert result.feedback is None or not result.feedback.is_correct
+
+def test_single_short_keyword_needs_exact_match():
+    assert not app2.stem_in_answer("loi", {"loin"})
+    assert app2.stem_in_answer("loi", {"loi"})
+
+def test_long_keywords_tolerate_typos():
+    result = app2.pregrade_open_answer("La fotosynthèse produit de l'oxygène.", ["photosynthèse", "oxygène"])
+    assert result.feedback is not None and result.feedback.is_correct